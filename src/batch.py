@@ -0,0 +1,593 @@
+#!/usr/bin/env python
+
+# Corpus mode for nxml2txt: converts large numbers of PMC NXML files
+# into text and standoffs using a pool of worker processes.
+
+# This module is not meant to be run directly; it is invoked by the
+# nxml2txt driver when given options, directories or several input
+# files, e.g.
+#
+#    ./nxml2txt -j 8 -d OUTDIR CORPUSDIR
+
+from __future__ import with_statement
+
+import sys
+import os
+import glob
+import time
+import tarfile
+import hashlib
+
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+from multiprocessing.util import Finalize
+
+import rewritetex
+import rewriteu2a
+import standoff
+import timing
+
+# suffix identifying input files when scanning directories
+NXML_SUFFIX = '.nxml'
+
+# suffixes identifying archives (e.g. the PMC OA bulk packages) whose
+# .nxml members are read as a stream instead of from disk
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+
+# number of documents handed to a worker process at a time
+CHUNK_SIZE = 16
+
+# Version of the conversion pipeline recorded in the manifest. Changes
+# to the code of the pipeline modules and to the Unicode mapping are
+# picked up from their content; bump this for changes that alter the
+# output otherwise (e.g. of the external TeX tools invoked), so that
+# incremental runs reconvert previously converted documents.
+PIPELINE_VERSION = '1'
+
+# modules (in this directory) whose code determines the output for a
+# given input
+PIPELINE_MODULES = ('fused', 'respace', 'rewritemmla', 'rewritetex',
+                    'rewriteu2a', 'standoff', 'tags', 'texmath')
+
+# number of manifest updates to group into a single transaction
+MANIFEST_COMMIT_INTERVAL = 100
+
+# conversion outcomes
+CONVERTED, FAILED, SKIPPED = 'converted', 'failed', 'skipped'
+
+USAGE='%(prog)s [OPTIONS] INPUT [INPUT ...]'
+
+def argparser():
+    import argparse
+    ap=argparse.ArgumentParser(description='Convert PMC NXML files to text and standoff annotations in parallel.', usage=USAGE)
+    ap.add_argument('-j', '--jobs', default=None, type=int, metavar='N', help='number of worker processes (default: number of CPUs)')
+    ap.add_argument('-d', '--directory', default=None, metavar='DIR', help='output directory (default: next to input)')
+    ap.add_argument('-l', '--list', default=None, metavar='FILE', help='read input file names from FILE, one per line')
+    ap.add_argument('-t', '--tar', default=None, metavar='FILE', help='write output into tar archive FILE (.tar or .tar.gz)')
+    ap.add_argument('-m', '--manifest', default=None, metavar='FILE', help='record converted documents in FILE and skip unchanged ones on reruns')
+    ap.add_argument('-f', '--force', default=False, action='store_true', help='reconvert all documents, ignoring the manifest')
+    ap.add_argument('-T', '--timing', default=None, metavar='FILE', help='write per-document stage timings into FILE and print a summary')
+    ap.add_argument('--profile', default=None, metavar='DIR', help='write cProfile output for each stage into DIR')
+    ap.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output')
+    ap.add_argument('input', nargs='*', help='input NXML file, directory or glob pattern')
+    return ap
+
+def is_corpus_invocation(args):
+    """
+    Given the command-line arguments of the nxml2txt driver (without
+    the program name), returns whether they request corpus mode
+    rather than the single-file NXMLFILE [TEXTFILE] [SOFILE] form.
+    """
+
+    for i, a in enumerate(args):
+        if a.startswith('-') and a != '-':
+            return True
+        if os.path.isdir(a) or is_archive(a):
+            return True
+        # single-file mode would overwrite any further .nxml
+        if i > 0 and a.endswith(NXML_SUFFIX):
+            return True
+    return False
+
+def find_inputs(paths, listfn=None):
+    """
+    Given a list of files, directories and glob patterns, generates
+    (filename, relative name) pairs for the input NXML files. The
+    relative name is the path under a given directory, or the base
+    name for individual files, and determines output locations.
+    """
+
+    if listfn is not None:
+        with open(listfn) as f:
+            for l in f:
+                l = l.strip()
+                if l and l[0] != '#':
+                    yield l, os.path.basename(l)
+
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                for fn in sorted(files):
+                    if fn.endswith(NXML_SUFFIX):
+                        path = os.path.join(root, fn)
+                        yield path, os.path.relpath(path, p)
+        elif not os.path.exists(p) and glob.has_magic(p):
+            for fn in sorted(glob.glob(p)):
+                yield fn, os.path.basename(fn)
+        else:
+            yield p, os.path.basename(p)
+
+def unique_inputs(inputs):
+    """
+    Filters (filename, relative name) pairs to the first one for each
+    file, also where given by different paths.
+    """
+
+    seen = set()
+    for fn, relname in inputs:
+        path = os.path.realpath(fn)
+        if path not in seen:
+            seen.add(path)
+            yield fn, relname
+
+def is_archive(fn):
+    return fn.endswith(ARCHIVE_SUFFIXES)
+
+def read_archive(fn):
+    """
+    Generates (name, data, relative name) triples for the .nxml
+    members of the given tar archive, reading it as a stream without
+    extracting it to disk.
+    """
+
+    with tarfile.open(fn, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(NXML_SUFFIX):
+                continue
+            # in stream mode the member must be read before advancing
+            data = tar.extractfile(member).read()
+            yield '%s:%s' % (fn, member.name), data, member.name
+
+def read_inputs(inputs):
+    """
+    Given (filename, relative name) pairs, generates (name, data,
+    relative name) triples, where data holds the document content for
+    archive members and is None for files to be read by the workers.
+    """
+
+    for fn, relname in inputs:
+        if is_archive(fn):
+            for member in read_archive(fn):
+                yield member
+        else:
+            yield fn, None, relname
+
+def output_names(fn, relname, directory=None):
+    """
+    Returns the names of the text and standoff files to write for the
+    given input.
+    """
+
+    if directory is not None:
+        base = os.path.join(directory, relname)
+    else:
+        base = fn
+    if base.endswith(NXML_SUFFIX):
+        base = base[:-len(NXML_SUFFIX)]
+    return base + '.txt', base + '.so'
+
+def make_jobs(inputs, options):
+    for name, data, relname in inputs:
+        if options.tar is not None:
+            # output goes into the archive under the relative name
+            textfn, sofn = output_names(relname, relname)
+        elif data is not None:
+            # archive members can't be written next to their input
+            textfn, sofn = output_names(relname, relname,
+                                        options.directory or '')
+        else:
+            textfn, sofn = output_names(name, relname, options.directory)
+        yield name, data, textfn, sofn
+
+def unique_outputs(jobs, clashes):
+    """
+    Filters jobs to those whose output does not clash with that of an
+    earlier job, appending the names of the others to clashes.
+    """
+
+    written = {}
+    for job in jobs:
+        name, data, textfn, sofn = job
+        path = os.path.abspath(textfn)
+        if path in written:
+            print >> sys.stderr, 'nxml2txt: not converting %s: output %s would overwrite that of %s' % \
+                (name, textfn, written[path])
+            clashes.append(name)
+            continue
+        written[path] = name
+        yield job
+
+def format_standoffs(standoffs):
+    return ''.join('%s\n' % so for so in standoffs)
+
+class TarOutput(object):
+    """
+    Writes conversion output as members of a tar archive. The archive
+    is written under a temporary name and only replaces any previous
+    archive of the same name when closed, so that members can be
+    copied over from the previous archive.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.partfn = filename + '.part'
+        mode = 'w|gz' if filename.endswith(('.gz', '.tgz')) else 'w|'
+        self.tar = tarfile.open(self.partfn, mode)
+
+    def add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, BytesIO(data))
+
+    def copy_previous(self, names):
+        """
+        Copies the members with the given names from the previous
+        archive, returning the set of names copied.
+        """
+
+        copied = set()
+        if not os.path.exists(self.filename):
+            return copied
+        with tarfile.open(self.filename, 'r|*') as previous:
+            for member in previous:
+                if member.name in names and member.name not in copied:
+                    self.tar.addfile(member, previous.extractfile(member))
+                    copied.add(member.name)
+        return copied
+
+    def close(self):
+        self.tar.close()
+        os.rename(self.partfn, self.filename)
+
+    def abort(self):
+        """
+        Discards the archive, leaving any previous one in place.
+        """
+
+        self.tar.close()
+        os.remove(self.partfn)
+
+def pipeline_version():
+    """
+    Returns a string identifying the pipeline code and configuration
+    that determine the output for a given input.
+    """
+
+    sha1 = hashlib.sha1(PIPELINE_VERSION)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    sources = [os.path.join(directory, m + '.py') for m in PIPELINE_MODULES]
+    # the driver, which sets the options of the pipeline stages
+    sources.append(os.path.join(directory, os.pardir, 'nxml2txt'))
+    for fn in sources + [rewriteu2a.MAPPING_FILE_NAME]:
+        try:
+            with open(fn, 'rb') as f:
+                sha1.update(f.read())
+        except IOError:
+            pass
+    return '%s-%s' % (PIPELINE_VERSION, sha1.hexdigest()[:12])
+
+class Manifest(object):
+    """
+    SQLite record of converted documents with their content hash,
+    pipeline version and outputs, used to skip documents that are
+    unchanged since a previous (possibly interrupted) run.
+    """
+
+    def __init__(self, db, commit_interval=MANIFEST_COMMIT_INTERVAL):
+        self.db = db
+        self.commit_interval = commit_interval
+        self.pending = 0
+
+    def entries(self):
+        """
+        Returns a dict mapping input names to (hash, version, outputs)
+        tuples for all recorded documents.
+        """
+
+        cursor = self.db.cursor()
+        cursor.execute('SELECT input, hash, version, outputs FROM manifest')
+        entries = dict((r[0], tuple(r[1:])) for r in cursor)
+        cursor.close()
+        return entries
+
+    def set(self, name, digest, version, outputs):
+        self.db.execute('INSERT OR REPLACE INTO manifest VALUES (?,?,?,?)',
+                        (name, digest, version, outputs))
+        self.pending += 1
+        if (self.commit_interval is not None and
+            self.pending >= self.commit_interval):
+            self.commit()
+
+    def remove(self, name):
+        self.db.execute('DELETE FROM manifest WHERE input = ?', (name,))
+        self.pending += 1
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self, commit=True):
+        """
+        Closes the manifest, discarding the uncommitted updates unless
+        commit is True.
+        """
+
+        if commit:
+            self.commit()
+        else:
+            self.db.rollback()
+        self.db.close()
+        self.db = None
+
+    @classmethod
+    def load(cls, filename, commit_interval=MANIFEST_COMMIT_INTERVAL):
+        import sqlite3
+        db = sqlite3.connect(filename, timeout=rewritetex.SQLITE_TIMEOUT)
+        db.text_factory = str
+        db.execute('CREATE TABLE IF NOT EXISTS manifest(input TEXT PRIMARY KEY,'
+                   ' hash TEXT, version TEXT, outputs TEXT)')
+        db.commit()
+        return cls(db, commit_interval)
+
+def format_outputs(textfn, sofn, options):
+    if options.tar is not None:
+        return '%s:%s\t%s:%s' % (options.tar, textfn, options.tar, sofn)
+    else:
+        return '%s\t%s' % (textfn, sofn)
+
+# Per-process state, set up once in each worker by init_worker() so
+# that the Unicode mapping and TeX cache are not reloaded for every
+# document.
+_worker = {}
+
+def init_worker(convert, options=None, manifest=None, version=None):
+    _worker['convert'] = convert
+    _worker['options'] = options
+    _worker['manifest'] = manifest if manifest is not None else {}
+    _worker['version'] = version
+    _worker['cache'] = rewritetex.get_cache()
+    _worker['mapping'] = rewriteu2a.load_mapping()
+
+    # write out buffered TeX cache entries when the process exits
+    Finalize(_worker['cache'], _worker['cache'].flush, exitpriority=10)
+
+    timer, profile_dir = None, getattr(options, 'profile', None)
+    if getattr(options, 'timing', None) is not None or profile_dir is not None:
+        timer = timing.StageTimer(profile=profile_dir is not None)
+        if profile_dir is not None:
+            # write out profiles when the worker process exits
+            Finalize(timer, timer.dump_profiles, (profile_dir,),
+                     exitpriority=10)
+    _worker['timer'] = timer
+
+def _makedirs(fn):
+    d = os.path.dirname(fn)
+    if d and not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError:
+            # possibly created concurrently by another worker
+            if not os.path.isdir(d):
+                raise
+
+def is_current(name, digest, textfn, sofn):
+    """
+    Returns whether the manifest records the given input as converted
+    from identical content by the current pipeline into outputs that
+    are still in place.
+    """
+
+    options = _worker['options']
+    outputs = format_outputs(textfn, sofn, options)
+    if _worker['manifest'].get(name) != (digest, _worker['version'], outputs):
+        return False
+    if options.tar is not None:
+        # copied over from the previous archive by run()
+        return True
+    return os.path.exists(textfn) and os.path.exists(sofn)
+
+def convert_one(job):
+    """
+    Converts a single document in a worker process. Returns a tuple
+    (name, outcome, error message, output, content hash, timings,
+    Unicode rewriting stats), where output holds the (text file name,
+    text, standoff file name, standoffs) to write if output goes into
+    an archive and is None otherwise. The content hash is None unless
+    a manifest is kept, the stage timings None unless timing or
+    profiling, and the rewriteu2a.Stats None unless timing or verbose.
+    """
+
+    name, data, textfn, sofn = job
+    options = _worker['options']
+    timer = _worker['timer']
+    digest, output = None, None
+    u2a_stats = None
+    if options.timing is not None or options.verbose:
+        u2a_stats = rewriteu2a.Stats()
+    try:
+        if options.manifest is not None:
+            if data is None:
+                with open(name, 'rb') as f:
+                    data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            if not options.force and is_current(name, digest, textfn, sofn):
+                return name, SKIPPED, None, None, digest, None, None
+
+        source = BytesIO(data) if data is not None else name
+        text, standoffs = _worker['convert'](source, cache=_worker['cache'],
+                                             mapping=_worker['mapping'],
+                                             timer=timer, u2a_stats=u2a_stats)
+        if options.tar is not None:
+            output = (textfn, text.encode('utf-8'),
+                      sofn, format_standoffs(standoffs))
+        else:
+            _makedirs(textfn)
+            _makedirs(sofn)
+            standoff.write_text(text, textfn)
+            standoff.write_standoffs(standoffs, sofn)
+    except Exception, e:
+        message = '%s: %s' % (type(e).__name__, str(e))
+        if timer is not None:
+            timer.pop_document()
+        return name, FAILED, message, None, digest, None, None
+    timings = timer.pop_document() if timer is not None else None
+    return name, CONVERTED, None, output, digest, timings, u2a_stats
+
+def run(convert, options):
+    """
+    Converts all inputs identified by options using the given
+    conversion function (the nxml2txt() pipeline). Returns the number
+    of documents that failed to convert.
+    """
+
+    # inputs given more than once are converted once, and inputs with
+    # the same output name (e.g. files with the same name in
+    # different directories under -d) only the first time
+    inputs = unique_inputs(find_inputs(options.input, options.list))
+    clashes = []
+    jobs = unique_outputs(make_jobs(read_inputs(inputs), options), clashes)
+
+    tar = TarOutput(options.tar) if options.tar is not None else None
+
+    manifest, entries, version = None, None, None
+    if options.manifest is not None:
+        _makedirs(options.manifest)
+        if tar is not None:
+            # the recorded outputs only exist once the archive is
+            # complete, so updates are committed together with it
+            manifest = Manifest.load(options.manifest, None)
+        else:
+            manifest = Manifest.load(options.manifest)
+        entries = manifest.entries()
+        version = pipeline_version()
+        if tar is not None and not os.path.exists(options.tar):
+            # nothing to copy unchanged documents from
+            entries = {}
+    # output names are needed to record results in the manifest and
+    # to copy the output of unchanged documents into a new archive
+    outputs, members, unchanged = {}, {}, {}
+    def record(jobs):
+        for job in jobs:
+            name, data, textfn, sofn = job
+            if manifest is not None:
+                outputs[name] = format_outputs(textfn, sofn, options)
+                if tar is not None:
+                    members[name] = (textfn, sofn)
+            yield job
+
+    timing_file, summary = None, None
+    if options.timing is not None:
+        _makedirs(options.timing)
+        timing_file = open(options.timing, 'w')
+    if options.timing is not None or options.profile is not None:
+        summary = timing.Summary()
+    if options.profile is not None and not os.path.isdir(options.profile):
+        os.makedirs(options.profile)
+    u2a_stats = None
+    if options.timing is not None or options.verbose:
+        u2a_stats = rewriteu2a.Stats()
+
+    processes = options.jobs if options.jobs is not None else cpu_count()
+
+    pool = None
+    initargs = (convert, options, entries, version)
+    if processes <= 1:
+        init_worker(*initargs)
+        results = (convert_one(j) for j in record(jobs))
+    else:
+        pool = Pool(processes, init_worker, initargs)
+        results = pool.imap_unordered(convert_one, record(jobs), CHUNK_SIZE)
+
+    counts = { CONVERTED: 0, FAILED: 0, SKIPPED: 0 }
+    completed = False
+    try:
+        for name, outcome, message, output, digest, timings, u2a in results:
+            counts[outcome] += 1
+            if u2a is not None:
+                u2a_stats.merge(u2a)
+            if timings is not None:
+                summary.add(timings)
+                if timing_file is not None:
+                    timing_file.write(timing.format_timings(name, timings))
+            if outcome == FAILED:
+                print >> sys.stderr, 'nxml2txt: failed to convert %s: %s' % \
+                    (name, message)
+            if output is not None:
+                textfn, text, sofn, standoffs = output
+                tar.add(textfn, text)
+                tar.add(sofn, standoffs)
+            if manifest is not None:
+                if outcome == CONVERTED:
+                    manifest.set(name, digest, version, outputs[name])
+                elif outcome == SKIPPED and tar is not None:
+                    for member in members[name]:
+                        unchanged[member] = name
+                outputs.pop(name, None)
+                members.pop(name, None)
+        counts[FAILED] += len(clashes)
+
+        if unchanged:
+            copied = tar.copy_previous(unchanged)
+            missing = set(n for m, n in unchanged.items() if m not in copied)
+            for name in sorted(missing):
+                print >> sys.stderr, 'nxml2txt: output for %s missing from ' \
+                    '%s, reconverting on the next run' % (name, options.tar)
+                manifest.remove(name)
+        if tar is not None:
+            tar.close()
+            tar = None
+        completed = True
+    finally:
+        if tar is not None:
+            tar.abort()
+        # keep the record of completed work also if interrupted,
+        # except for output lost with an incomplete archive
+        if manifest is not None:
+            manifest.close(completed or options.tar is None)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elif _worker['timer'] is not None and options.profile is not None:
+        _worker['timer'].dump_profiles(options.profile)
+
+    if timing_file is not None:
+        timing_file.close()
+
+    if options.profile is not None:
+        timing.merge_profiles(options.profile)
+
+    if summary is not None:
+        print >> sys.stderr, str(summary)
+
+    if u2a_stats is not None:
+        print >> sys.stderr, 'nxml2txt: unicode rewriting: %s' % str(u2a_stats)
+
+    if options.verbose:
+        print >> sys.stderr, 'nxml2txt: converted %d, failed %d, skipped %d' \
+            % (counts[CONVERTED], counts[FAILED], counts[SKIPPED])
+
+    return counts[FAILED]
+
+def main(argv, convert):
+    options = argparser().parse_args(argv[1:])
+
+    if not options.input and options.list is None:
+        argparser().print_usage(sys.stderr)
+        return 1
+
+    failed = run(convert, options)
+
+    return 0 if failed == 0 else 1
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 
-# Print unique <tex-math> elements from PMC NXML files.
+# Print unique <tex-math> elements from PMC NXML files, or, with -p,
+# prewarm the TeX cache (data/tex2txt.db) by converting those missing
+# from it, e.g.
+#
+#    python extracttex.py -p -j 8 CORPUSDIR
+#
+# With -c, compare the in-process conversions of texmath against the
+# catdvi conversions in the TeX cache for the formulas found in both.
 
 # Helper for nxml2txt development.
 
@@ -11,22 +18,21 @@ import codecs
 
 from lxml import etree as ET
 
+import rewritetex
+import texmath
+from rewritetex import normalize_tex
+
 # command-line options
 options = None
 
+# number of formulas to convert between saves of the cache in prewarm
+# mode, so that an interrupted run keeps most of its work
+PREWARM_CHUNK_SIZE = 1000
+
 # pre-compiled regular expressions
 
-# key declarations in tex documents
-texdecl_re = re.compile(r'(\\(?:documentclass|usepackage|setlength|pagestyle)(?:\[[^\[\]]*\])?(?:\{[^\{\}]*\})*)')
-# document start or end
-texdoc_re = re.compile(r'(\\(?:begin|end)(?:\[[^\[\]]*\])?\{document\})')
-# includes for "standard" tex packages
-texstdpack_re = re.compile(r'\\usepackage\{(?:amsbsy|amsfonts|amsmath|amssymb|mathrsfs|upgreek|wasysym)\}')
 # consequtive space
 space_re = re.compile(r'\s+')
-# initial and terminal space.
-docstartspace_re = re.compile(r'^\s*')
-docendspace_re   = re.compile(r'\s*$')
 
 ##########
 
@@ -34,32 +40,6 @@ docendspace_re   = re.compile(r'\s*$')
 exttex_cache_hits = 0
 exttex_cache_misses = 0
 
-def normalize_tex(s):
-    """
-    Given the string content of a tex document, returns a normalized
-    version of its content, abstracting away "standard" declarations
-    and includes.
-    """
-
-    # Note: this could be made more effective by including synonymous
-    # commands in tex and more removing content-neutral formatting
-    # more aggressively.
-
-    # remove "standard" package includes
-    s = texstdpack_re.sub('', s)
-
-    # remove header boilerplate declarations (superset of texstdpack_re)
-    s = texdecl_re.sub(r'', s)
-
-    # replace any amount of consequtive space by a single plain space
-    s = space_re.sub(' ', s)
-
-    # eliminate doc-initial and -terminal space.
-    s = docstartspace_re.sub('', s)
-    s = docendspace_re.sub('', s)
-
-    return s
-
 def compilable(tex):
     """Return tex-math content wrapped so that it can be compiled using tex."""
 
@@ -107,11 +87,160 @@ def process(fn, tex_set={}):
             tex_set.add(tex_norm)
     return True
 
+def find_files(paths):
+    """
+    Generates the names of the given files and of the .nxml files
+    in the given directories.
+    """
+
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                for fn in sorted(files):
+                    if fn.endswith('.nxml'):
+                        yield os.path.join(root, fn)
+        else:
+            yield p
+
+def scan_file(fn):
+    """
+    Returns (normalized tex, tex) pairs for the unique <tex-math>
+    elements in the given file.
+    """
+
+    try:
+        tree = ET.parse(fn)
+    except ET.XMLSyntaxError:
+        print >> sys.stderr, "Error parsing %s" % fn
+        return []
+
+    seen, found = set(), []
+    for e in tree.getroot().xpath("//*[local-name()='tex-math']"):
+        if e.text is None:
+            continue
+        tex_norm = normalize_tex(e.text)
+        if tex_norm not in seen:
+            seen.add(tex_norm)
+            found.append((tex_norm, e.text))
+    return found
+
+def prewarm(files, cache, options):
+    """
+    Finds the unique <tex-math> elements in the given files and
+    converts those missing from the cache, storing the results.
+    """
+
+    global exttex_cache_hits, exttex_cache_misses
+
+    # scan files in parallel, deduplicating formulas across the corpus
+    if options.jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(options.jobs)
+        scanned = pool.imap(scan_file, files, 16)
+    else:
+        pool = None
+        scanned = (scan_file(fn) for fn in files)
+
+    texs, order = {}, []
+    for found in scanned:
+        for tex_norm, tex in found:
+            if tex_norm in texs:
+                exttex_cache_hits += 1
+            else:
+                exttex_cache_misses += 1
+                texs[tex_norm] = tex
+                order.append(tex_norm)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # formulas converted in-process by texmath need no prewarming
+    cached = cache.get_many(order)
+    missing = [n for n in order if n not in cached]
+    inprocess = set(n for n in missing
+                    if texmath.tex2str(rewritetex.prepare_tex(texs[n])) is not None)
+    missing = [n for n in missing if n not in inprocess]
+    known = rewritetex.known_failures(cache, missing)
+    missing = [n for n in missing if n not in known]
+
+    if options.verbose:
+        print >> sys.stderr, 'extracttex: %d unique, %d missing from cache, %d converted in-process, %d known failures' % \
+            (len(order), len(missing), len(inprocess), len(known))
+
+    converted, failed = 0, 0
+    for start in range(0, len(missing), PREWARM_CHUNK_SIZE):
+        chunk = missing[start:start+PREWARM_CHUNK_SIZE]
+        failures = {}
+        results = rewritetex.tex2str_batch([texs[n] for n in chunk],
+                                           options.batch_size, options.jobs,
+                                           failures)
+        for i, (tex_norm, s) in enumerate(zip(chunk, results)):
+            if s is None or s == "":
+                reason = failures.get(i, rewritetex.FAILURE_EMPTY)
+                if reason not in rewritetex.TRANSIENT_FAILURES:
+                    cache.add_failure(tex_norm, reason,
+                                      rewritetex.tex_toolchain())
+                failed += 1
+            else:
+                cache.set(tex_norm, s)
+                converted += 1
+        cache.flush()
+
+        if options.verbose:
+            print >> sys.stderr, 'extracttex: converted %d, failed %d' % \
+                (converted, failed)
+
+    return converted, failed
+
+def compare(files, cache, options):
+    """
+    Compares the in-process conversions of the unique <tex-math>
+    elements in the given files to those in the cache, printing
+    differences. Returns (compared, differing) counts.
+    """
+
+    texs, order = {}, []
+    for fn in files:
+        for tex_norm, tex in scan_file(fn):
+            if tex_norm not in texs:
+                texs[tex_norm] = tex
+                order.append(tex_norm)
+
+    converted = {}
+    for tex_norm in order:
+        s = texmath.tex2str(rewritetex.prepare_tex(texs[tex_norm]))
+        if s is not None:
+            converted[tex_norm] = s
+    cached = cache.get_many([n for n in order if n in converted])
+
+    compared, differing = 0, 0
+    for tex_norm in order:
+        if tex_norm not in cached:
+            continue
+        compared += 1
+        if cached[tex_norm] != converted[tex_norm]:
+            differing += 1
+            print (u'%s\n\tcached:  %s\n\ttexmath: %s' % \
+                (tex_norm, cached[tex_norm], converted[tex_norm])).encode('utf-8')
+
+    if options.verbose:
+        print >> sys.stderr, 'extracttex: %d unique, %d converted in-process, %d of these cached' % \
+            (len(order), len(converted), len(cached))
+
+    return compared, differing
+
 def argparser():
     import argparse
+    from multiprocessing import cpu_count
     ap=argparse.ArgumentParser(description='Extract <tex-math> element content from PMC NXML files.')
     ap.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output')
-    ap.add_argument('file', nargs='+', help='input PubMed Central NXML file')
+    ap.add_argument('-p', '--prewarm', default=False, action='store_true', help='convert formulas missing from the TeX cache and store them instead of printing')
+    ap.add_argument('-c', '--compare', default=False, action='store_true', help='compare in-process conversions to those in the TeX cache instead of printing')
+    ap.add_argument('-j', '--jobs', default=cpu_count(), type=int, metavar='N', help='number of parallel jobs for prewarming (default: number of CPUs)')
+    ap.add_argument('-b', '--batch-size', default=rewritetex.TEX_BATCH_SIZE, type=int, metavar='N', help='compile up to N formulas in one tex document (default %d)' % rewritetex.TEX_BATCH_SIZE)
+    ap.add_argument('file', nargs='+', help='input PubMed Central NXML file or directory')
     return ap
     
 def main(argv):
@@ -120,9 +249,28 @@ def main(argv):
 
     options = argparser().parse_args(argv[1:])
 
-    tex_set = set()
-    for fn in options.file:
-        process(fn, tex_set)
+    if options.prewarm:
+        # checking for cached formulas is not a use of them
+        cache = rewritetex.get_cache(count_hits=False)
+        try:
+            prewarm(find_files(options.file), cache, options)
+        finally:
+            cache.save()
+    elif options.compare:
+        try:
+            cache = rewritetex.SqliteCache.load(readonly=True)
+        except Exception, e:
+            print >> sys.stderr, 'extracttex: failed to open the TeX cache: %s' % str(e)
+            return 1
+        compared, differing = compare(find_files(options.file), cache,
+                                      options)
+        print '%d cached formulas compared, %d differ' % (compared, differing)
+        if differing:
+            return 1
+    else:
+        tex_set = set()
+        for fn in find_files(options.file):
+            process(fn, tex_set)
 
     if options.verbose and any (value for value in (exttex_cache_hits, exttex_cache_misses) if value != 0):
         print >> sys.stderr, 'extracttex: %d dup, %d unique' % (exttex_cache_hits, exttex_cache_misses)
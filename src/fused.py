@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Conversion of a parsed PMC NXML tree into text and standoffs with
+# few traversals of the tree.
+
+# This module is not meant to be run directly; the nxml2txt driver
+# uses it to run the rewritetex, rewritemmla, respace, rewriteu2a and
+# standoff stages on a tree. Instead of each stage searching or
+# walking the whole tree, a single scan finds the TeX and MathML
+# elements for their handlers, and Unicode is rewritten during the
+# traversal that extracts the text and standoffs. The output is
+# identical to that of running the stages one after another.
+
+import rewritetex
+import rewritemmla
+import respace
+import rewriteu2a
+import standoff
+import timing
+
+# tags of the elements handled by rewritetex (in any namespace) and
+# rewritemmla
+TEX_MATH_TAG = '{*}tex-math'
+MATH_TAG = '{%s}math' % rewritemmla.MATHML_NAMESPACE
+ANNOTATION_TAG = '{%s}annotation' % rewritemmla.MATHML_NAMESPACE
+
+def scan(root):
+    """
+    Returns the TeX math, MathML math and MathML annotation elements
+    under the given root, each in document order.
+    """
+
+    tex, math, annotations = [], [], []
+    for e in root.iter(TEX_MATH_TAG, MATH_TAG, ANNOTATION_TAG):
+        if e.tag == MATH_TAG:
+            math.append(e)
+        elif e.tag == ANNOTATION_TAG:
+            annotations.append(e)
+        else:
+            tex.append(e)
+    return tex, math, annotations
+
+class _U2a(object):
+    def __init__(self, mapping, missing, options, stats=None):
+        self.mapping = mapping
+        self.missing = missing
+        self.options = options
+        self.stats = stats
+
+    def text(self, e):
+        rewriteu2a.replace_mapped_text(e, self.mapping, self.missing,
+                                       self.options, self.stats)
+
+    def tail(self, e, parent):
+        rewriteu2a.replace_mapped_tail(e, self.mapping, self.missing,
+                                       parent, self.options, self.stats)
+
+    def ascii_subtree(self, e):
+        return rewriteu2a.ascii_subtree(e, self.stats)
+
+def text_and_standoffs(root, u2a=None):
+    """
+    Returns the text content of the tree under the given root and
+    standoffs for its elements as standoff.text_and_standoffs(),
+    rewriting Unicode with the given _U2a, if any, as each text and
+    tail is reached.
+    """
+
+    strings, standoffs = [], []
+    _text_and_standoffs(root, 0, strings, standoffs, u2a)
+    text = u''.join(strings)
+    for so in standoffs:
+        so.text = text[so.start:so.end]
+    return text, standoffs
+
+def _text_and_standoffs(e, offset, strings, standoffs, u2a, depth=0):
+    # to keep standoffs in element occurrence order, append before
+    # recursing
+    so = standoff.Standoff(len(standoffs)+1, e, offset, 0, u'')
+    standoffs.append(so)
+
+    # as rewriteu2a.replace_mapped(), leave subtrees holding ASCII
+    # only unchanged (the tail of e is handled with its parent)
+    if u2a is not None and depth == rewriteu2a.ASCII_SUBTREE_DEPTH and \
+            len(e) and u2a.ascii_subtree(e):
+        u2a = None
+
+    if e.text:
+        if u2a is not None:
+            u2a.text(e)
+        strings.append(e.text)
+        offset += len(e.text)
+
+    # rewriting tails inserts elements after the current one, so
+    # iterate by sibling to visit these too
+    c = e[0] if len(e) else None
+    while c is not None:
+        if standoff.is_standard_element(c):
+            # the content of comments, processing instructions and
+            # entities is ignored (except for the tail)
+            offset = _text_and_standoffs(c, offset, strings, standoffs, u2a,
+                                         depth+1)
+        if c.tail:
+            if u2a is not None:
+                u2a.tail(c, e)
+            strings.append(c.tail)
+            offset += len(c.tail)
+        c = c.getnext()
+
+    so.end = offset
+    return offset
+
+def convert_tree(tree, cache=None, tex_options=None, mapping=None,
+                 u2a_options=None, timer=None, u2a_stats=None):
+    """
+    Converts the given tree as the stages of the pipeline would,
+    returning its text and standoffs. Counts of the text skipped by
+    Unicode rewriting as ASCII only are added to u2a_stats, if given.
+    """
+
+    if timer is None:
+        timer = timing.NullTimer()
+    if mapping is None:
+        mapping = rewriteu2a.load_mapping()
+
+    root = tree.getroot()
+
+    with timer.stage('scan'):
+        tex, math, annotations = scan(root)
+
+    # process embedded TeX math
+    with timer.stage('tex'):
+        rewritetex.process_tree(tree, cache=cache, options=tex_options,
+                                elements=tex)
+
+    # process MathML
+    with timer.stage('mmla'):
+        rewritemmla.process_tree(tree, math=math, annotations=annotations)
+
+    # normalize whitespace
+    with timer.stage('respace'):
+        respace.process_tree(tree)
+
+    # map unicode to ASCII while converting to text and standoffs
+    with timer.stage('text'):
+        u2a = _U2a(mapping, set(), u2a_options, u2a_stats)
+        text, standoffs = text_and_standoffs(root, u2a)
+        standoffs = standoff.finish_standoffs(standoffs)
+
+    return text, standoffs
@@ -14,9 +14,12 @@ import sys
 import os
 import re
 import codecs
+import bisect
 
 from lxml import etree as ET
 
+import tags
+
 class ParseError:
     pass
 
@@ -85,11 +88,24 @@ space_wrap_element = set([
 # aggressive in cases but guarantees normalization
 strip_element = newline_wrap_element | space_wrap_element
 
+def _wrap(tag):
+    if tag in newline_wrap_element:
+        return "\n"
+    elif tag in space_wrap_element:
+        return " "
+    else:
+        return None
+
+# space to wrap elements with by tag, if any
+wrap_space = tags.TagTable(_wrap)
+
 class Standoff:
     def __init__(self, element, start, end):
         self.element = element
         self.start   = start
         self.end     = end
+        # index of the last standoff for the subtree of the element
+        self.last    = None
 
 def txt(s):
     return s if s is not None else ""
@@ -103,12 +119,10 @@ def is_standard_element(e):
         return False
 
 def text_and_standoffs(e):
-    strings, standoffs = [], []
-    _text_and_standoffs(e, 0, strings, standoffs)
-    text = "".join(strings)
-    return text, standoffs
+    model = TextModel(e)
+    return model.text, model.standoffs
     
-def _text_and_standoffs(e, curroff, strings, standoffs):
+def _text_and_standoffs(e, curroff, strings, standoffs, segments):
     startoff = curroff
     # to keep standoffs in element occurrence order, append
     # a placeholder before recursing
@@ -119,90 +133,383 @@ def _text_and_standoffs(e, curroff, strings, standoffs):
     # sense for entities.
     if e.text is not None and e.text != "" and is_standard_element(e):
         strings.append(e.text)
+        segments.append((curroff, e, False))
         curroff += len(e.text)
-    curroff = _subelem_text_and_standoffs(e, curroff, strings, standoffs)
+    curroff = _subelem_text_and_standoffs(e, curroff, strings, standoffs,
+                                          segments)
     so.start = startoff
     so.end   = curroff
+    so.last  = len(standoffs)-1
     return curroff
 
-def _subelem_text_and_standoffs(e, curroff, strings, standoffs):
+def _subelem_text_and_standoffs(e, curroff, strings, standoffs, segments):
     startoff = curroff
     for s in e:
-        curroff = _text_and_standoffs(s, curroff, strings, standoffs)
+        curroff = _text_and_standoffs(s, curroff, strings, standoffs,
+                                      segments)
         if s.tail is not None and s.tail != "":
             strings.append(s.tail)
+            segments.append((curroff, s, True))
             curroff += len(s.tail)
     return curroff
 
-def preceding_space(pos, text, rewritten={}):
-    while pos > 0:
-        pos -= 1
-        if pos not in rewritten: 
-            # no rewrite, check normally
-            return text[pos].isspace()           
-        elif rewritten[pos] is not None:
-            # refer to rewritten instead of original
-            return rewritten[pos].isspace()
-        else:
-            # character deleted, ignore position
-            pass
-    # accept start of text
-    return True
+class TextModel(object):
+    """
+    Text content of a tree and standoffs for its elements, built once
+    and then updated as processing changes the tree instead of being
+    rebuilt from it.
+    """
 
-def following_space(pos, text, rewritten={}):
-    while pos < len(text):
-        if pos not in rewritten: 
-            # no rewrite, check normally
-            return text[pos].isspace()           
-        elif rewritten[pos] is not None:
-            # refer to rewritten instead of original
-            return rewritten[pos].isspace()
-        else:
-            # character deleted, ignore position
-            pass
-        pos += 1
-    # accept end of text
-    return True
+    def __init__(self, root):
+        strings, self.standoffs = [], []
+        # (offset, element, is tail) for each nonempty text and tail,
+        # in text order
+        self.segments = []
+        _text_and_standoffs(root, 0, strings, self.standoffs, self.segments)
+        self.text = "".join(strings)
+
+    def refresh(self):
+        """
+        Updates the text and standoffs after changes to the texts and
+        tails of elements (but not to the structure of the tree).
+        """
+
+        # standoff offsets are at boundaries of segments, so each maps
+        # to the new offset of the segment starting there.
+        strings, segments, moved = [], [], {}
+        offset = 0
+        for start, e, tail in self.segments:
+            moved[start] = offset
+            s = e.tail if tail else e.text
+            if s:
+                strings.append(s)
+                segments.append((offset, e, tail))
+                offset += len(s)
+        moved[len(self.text)] = offset
+
+        for so in self.standoffs:
+            so.start = moved[so.start]
+            so.end = moved[so.end]
+        self.text = "".join(strings)
+        self.segments = segments
+
+    def insert(self, inserted):
+        """
+        Updates the text and standoffs after inserting elements with
+        single-character texts. inserted holds (pos, early, index,
+        element) for each element inserted at text position pos before
+        (if early) or after (relocating its tail) the element of the
+        standoff at the given index, with at most one per position.
+        """
+
+        standoffs = self.standoffs
+        inserted = sorted(inserted)
+        positions = [pos for pos, early, i, e in inserted]
+        at = dict((i[0], i) for i in inserted)
+
+        # each offset moves by the number of insertions before it; for
+        # an insertion at the same offset, this depends on where the
+        # standoff is relative to the element inserted before or after.
+        for j, so in enumerate(standoffs):
+            start, end = so.start, so.end
+            so.start = start + bisect.bisect_left(positions, start)
+            if start in at:
+                pos, early, i, e = at[start]
+                if early:
+                    after = j >= i
+                else:
+                    after = j > standoffs[i].last
+                if after:
+                    so.start += 1
+            so.end = end + bisect.bisect_left(positions, end)
+            if end in at:
+                pos, early, i, e = at[end]
+                if early:
+                    after = so.last >= i
+                else:
+                    after = (j > standoffs[i].last or
+                             (j < i and so.last >= i))
+                if after:
+                    so.end += 1
+
+        pieces, prev = [], 0
+        for pos, early, i, e in inserted:
+            pieces.append(self.text[prev:pos])
+            pieces.append(e.text)
+            prev = pos
+        pieces.append(self.text[prev:])
+
+        # the text of each inserted element starts a new segment, and
+        # a relocated tail moves to the inserted element
+        segments, k = [], 0
+        for start, e, tail in self.segments:
+            while k < len(inserted) and inserted[k][0] <= start:
+                pos, early, i, r = inserted[k]
+                segments.append((pos+k, r, False))
+                k += 1
+            if tail and start in at:
+                pos, early, i, r = at[start]
+                if not early and standoffs[i].element is e:
+                    e = r
+            segments.append((start+k, e, tail))
+        for pos, early, i, r in inserted[k:]:
+            segments.append((pos+k, r, False))
+            k += 1
+
+        # inserted standoffs go before the element or after its subtree
+        before, after = {}, {}
+        for k, (pos, early, i, e) in enumerate(inserted):
+            so = Standoff(e, pos+k, pos+k+1)
+            if early:
+                before[i] = so
+            else:
+                after.setdefault(standoffs[i].last, []).append((i, so))
+        result, index = [], []
+        for j, so in enumerate(standoffs):
+            if j in before:
+                before[j].last = len(result)
+                result.append(before[j])
+            index.append(len(result))
+            result.append(so)
+            for i, a in after.get(j, ()):
+                a.last = len(result)
+                result.append(a)
+        for j, so in enumerate(standoffs):
+            # elements inserted after the last descendant are in the
+            # subtree if they follow one of its descendants
+            last = so.last
+            so.last = index[last] + sum(1 for i, a in after.get(last, ())
+                                        if i > j)
+
+        self.text = "".join(pieces)
+        self.segments = segments
+        self.standoffs = result
+
+# states of text positions in RewriteIndex
+UNCHANGED = 0
+DELETED   = 1
+SPACE     = 2
+NEWLINE   = 3
+OTHER     = 4
+
+# runs of space other than newlines, skipped when looking for breaks
+space_run_re = re.compile(r'[^\S\n]+', re.U)
+
+class RewriteIndex(object):
+    """
+    Records which positions of a text have been deleted or rewritten
+    during processing, and answers queries on the space surrounding
+    positions of the rewritten text without walking it character by
+    character.
+    """
 
-def preceding_linebreak(pos, text, rewritten={}):
-    if pos >= len(text):
-        return True    
-    while pos > 0:
-        pos -= 1
-        c = rewritten.get(pos, text[pos])
-        if c == "\n":
-            return True
-        elif c is not None and not c.isspace():
-            return False
+    def __init__(self, text):
+        self.text = text
+        # state of each position, and characters for OTHER
+        self.state = bytearray(len(text))
+        self.other = {}
+        # sorted rewritten (not deleted) positions
+        self.rewrites = []
+        # links skipping deleted positions to the left (from i to j
+        # when positions j to i-1 are deleted) and to the right (from
+        # i to j when positions i to j-1 are deleted), recorded at the
+        # ends of deleted ranges and shortened on lookup
+        self.left = {}
+        self.right = {}
+        # starts and ends of runs of space, built on first use
+        self.run_starts = None
+        self.run_ends = None
+        # deleted positions outside of the text (see strip_elements)
+        self.outside = set()
+
+    def delete(self, start, end):
+        """
+        Records the positions from start to end (exclusive) as deleted.
+        Returns the positions already deleted, in order.
+        """
+
+        n = len(self.text)
+        if start < 0 or end > n:
+            # the content of special elements is not part of the
+            # text; only note these positions for repeated deletes
+            before = self._delete_outside(start, min(end, 0))
+            after = self._delete_outside(max(start, n), end)
+            return before + self.delete(max(start, 0), min(end, n)) + after
+        if start >= end:
+            return []
+
+        state = self.state[start:end]
+        if state.count(chr(UNCHANGED)) != end-start:
+            changed = [start+i for i, s in enumerate(state) if s != UNCHANGED]
         else:
-            # space or deleted, check further
-            pass
-    return True
+            changed = []
+        self.state[start:end] = chr(DELETED) * (end-start)
+
+        self.left[end] = start
+        self.right[start] = end
+        return changed
+
+    def _delete_outside(self, start, end):
+        changed = [pos for pos in range(start, end) if pos in self.outside]
+        self.outside.update(range(start, end))
+        return changed
+
+    def rewrite(self, pos, c):
+        """
+        Records the character at the given (not deleted) position as
+        rewritten to c.
+        """
+
+        if pos < 0:
+            # before the start of text; nothing to look up
+            return
+        if self.state[pos] == UNCHANGED:
+            bisect.insort(self.rewrites, pos)
+        if c == ' ':
+            self.state[pos] = SPACE
+        elif c == '\n':
+            self.state[pos] = NEWLINE
+        else:
+            self.state[pos] = OTHER
+            self.other[pos] = c
+
+    def is_deleted(self, pos):
+        if not 0 <= pos < len(self.text):
+            return pos in self.outside
+        return self.state[pos] == DELETED
+
+    def char(self, pos):
+        """
+        Returns the character at the given position after rewrites, or
+        None if deleted.
+        """
+
+        state = self.state[pos]
+        if state == UNCHANGED:
+            return self.text[pos]
+        elif state == DELETED:
+            return None
+        elif state == SPACE:
+            return ' '
+        elif state == NEWLINE:
+            return '\n'
+        else:
+            return self.other[pos]
+
+    def preceding_position(self, pos):
+        """
+        Returns the last position before the given one that has not
+        been deleted, or -1 if none.
+        """
+
+        state, left = self.state, self.left
+        i = pos
+        while i > 0 and state[i-1] == DELETED:
+            i = left.get(i, i-1)
+        if i != pos:
+            left[pos] = i
+        return i-1
+
+    def following_position(self, pos):
+        """
+        Returns the first position from the given one on that has not
+        been deleted, or len(text) if none.
+        """
+
+        state, right, n = self.state, self.right, len(self.text)
+        i = pos
+        while i < n and state[i] == DELETED:
+            i = right.get(i, i+1)
+        if i != pos:
+            right[pos] = i
+        return i
+
+    def _runs(self):
+        if self.run_starts is None:
+            self.run_starts, self.run_ends = [], []
+            for m in space_run_re.finditer(self.text):
+                self.run_starts.append(m.start())
+                self.run_ends.append(m.end())
+        return self.run_starts, self.run_ends
+
+    def _break_before(self, pos):
+        # last position up to pos whose original character is not
+        # space other than newline, or -1
+        starts, ends = self._runs()
+        r = bisect.bisect_right(starts, pos)-1
+        if r >= 0 and pos < ends[r]:
+            return starts[r]-1
+        return pos
+
+    def _break_after(self, pos):
+        # first position from pos on whose original character is not
+        # space other than newline, or len(text)
+        starts, ends = self._runs()
+        r = bisect.bisect_right(starts, pos)-1
+        if r >= 0 and pos < ends[r]:
+            return ends[r]
+        return pos
+
+    def _rewrite_before(self, pos):
+        # last rewritten position up to pos, or -1
+        i = bisect.bisect_right(self.rewrites, pos)
+        return self.rewrites[i-1] if i > 0 else -1
+
+    def _rewrite_after(self, pos):
+        # first rewritten position from pos on, or len(text)
+        i = bisect.bisect_left(self.rewrites, pos)
+        return self.rewrites[i] if i < len(self.rewrites) else len(self.text)
+
+    def preceding_space(self, pos):
+        if pos > 0 and self.state[pos-1] == UNCHANGED:
+            # the common case
+            return self.text[pos-1].isspace()
+        pos = self.preceding_position(pos)
+        if pos < 0:
+            # accept start of text
+            return True
+        return self.char(pos).isspace()
+
+    def following_space(self, pos):
+        if pos < len(self.text) and self.state[pos] == UNCHANGED:
+            return self.text[pos].isspace()
+        pos = self.following_position(pos)
+        if pos >= len(self.text):
+            # accept end of text
+            return True
+        return self.char(pos).isspace()
 
-def following_linebreak(pos, text, rewritten={}):
-    while pos < len(text):
-        c = rewritten.get(pos, text[pos])
-        if c == "\n":
+    def preceding_linebreak(self, pos):
+        if pos >= len(self.text):
             return True
-        elif c is not None and not c.isspace():
-            return False
-        else:
-            # space or deleted, check further
-            pass
-        pos += 1
-    return True
+        pos = self.preceding_position(pos)
+        while pos >= 0:
+            # skip space up to the last position that is either
+            # rewritten or not space in the original
+            pos = max(self._break_before(pos), self._rewrite_before(pos))
+            if pos < 0:
+                break
+            c = self.char(pos)
+            if c == '\n':
+                return True
+            elif c is not None and not c.isspace():
+                return False
+            pos = self.preceding_position(pos)
+        return True
 
-def index_in_parent(e, p):
-    """
-    Returns the index of the given element in its parent element e.
-    """
-    index = None
-    for i in range(len(p)):
-        if p[i] == e:
-            index = i
-            break
-    assert i is not None, "index_in_parent: error: not parent and child"
-    return i
+    def following_linebreak(self, pos):
+        pos = self.following_position(pos)
+        while pos < len(self.text):
+            pos = min(self._break_after(pos), self._rewrite_after(pos))
+            if pos >= len(self.text):
+                break
+            c = self.char(pos)
+            if c == '\n':
+                return True
+            elif c is not None and not c.isspace():
+                return False
+            pos = self.following_position(pos+1)
+        return True
 
 def space_normalize(root, text=None, standoffs=None):
     """
@@ -225,6 +532,7 @@ def strip_elements(root, elements_to_strip=set(), text=None, standoffs=None):
     """
     Removes initial and terminal space from elements that either have
     surrounding space or belong to given set of elements to strip.
+    Returns a RewriteIndex of the space removed from the text.
     """
 
     if text is None or standoffs is None:
@@ -232,7 +540,10 @@ def strip_elements(root, elements_to_strip=set(), text=None, standoffs=None):
 
     # during processing, keep note at which offsets spaces have
     # been eliminated.
-    rewritten = {}
+    rewritten = RewriteIndex(text)
+    # the "text" of special elements is not part of the text content;
+    # keep these apart for callers that need the text as stripped.
+    removed = RewriteIndex(text)
     
     for so in standoffs:
         e = so.element
@@ -246,21 +557,19 @@ def strip_elements(root, elements_to_strip=set(), text=None, standoffs=None):
         # space.
         if ((e.text is not None and e.text != "" and e.text[0].isspace()) and
             (element_in_set(e, elements_to_strip) or 
-             preceding_space(so.start, text, rewritten))):
+             rewritten.preceding_space(so.start))):
             l = 0
             while l < len(e.text) and e.text[l].isspace():
                 l += 1
             space, end = e.text[:l], e.text[l:]
-            for i in range(l):
-                o = so.start+i
-                if o not in rewritten:
-                    rewritten[o] = None
-                else:
-                    # Note: with lxml and empty special elements such as
-                    # comments and processing instructions, it's possible to
-                    # have double deletes. These should be rare and harmless.
-                    assert rewritten[o] is None, 'internal error'
-                    print >> sys.stderr, 'Note: dup remove at %d' % o
+            if is_standard_element(e):
+                removed.delete(so.start, so.start+l)
+            for o in rewritten.delete(so.start, so.start+l):
+                # Note: with lxml and empty special elements such as
+                # comments and processing instructions, it's possible to
+                # have double deletes. These should be rare and harmless.
+                assert rewritten.is_deleted(o), 'internal error'
+                print >> sys.stderr, 'Note: dup remove at %d' % o
             e.text = end
 
         # element-final space is in e.text only if the element has no
@@ -269,43 +578,43 @@ def strip_elements(root, elements_to_strip=set(), text=None, standoffs=None):
         if len(e) == 0:
             if ((e.text is not None and e.text != "" and e.text[-1].isspace()) and
                 (element_in_set(e, elements_to_strip) or 
-                 following_space(so.end, text, rewritten))):
+                 rewritten.following_space(so.end))):
                 l = 0
                 while l < len(e.text) and e.text[-l-1].isspace():
                     l += 1
                 start, space = e.text[:-l], e.text[-l:]
-                for i in range(l):
-                    o = so.end-i-1
-                    if o not in rewritten:
-                        rewritten[o] = None
-                    else:
-                        # Note: with lxml and empty special elements
-                        # such as comments and processing
-                        # instructions, it's possible to have double
-                        # deletes. These should be rare and harmless.
-                        assert rewritten[o] is None, 'internal error'
-                        print >> sys.stderr, "Note: dup remove at %d" % o
+                if is_standard_element(e):
+                    removed.delete(so.end-l, so.end)
+                for o in reversed(rewritten.delete(so.end-l, so.end)):
+                    # Note: with lxml and empty special elements
+                    # such as comments and processing
+                    # instructions, it's possible to have double
+                    # deletes. These should be rare and harmless.
+                    assert rewritten.is_deleted(o), 'internal error'
+                    print >> sys.stderr, "Note: dup remove at %d" % o
                 e.text = start
                     
         else:
             c = e[-1]
             if ((c.tail is not None and c.tail != "" and c.tail[-1].isspace()) and
                 (element_in_set(e, elements_to_strip) or 
-                 following_space(so.end, text, rewritten))):
+                 rewritten.following_space(so.end))):
                 l = 0
                 while l < len(c.tail) and c.tail[-l-1].isspace():
                     l += 1
                 start, space = c.tail[:-l], c.tail[-l:]
-                for i in range(l):
-                    o = so.end-i-1
-                    assert o not in rewritten, "ERROR: dup remove"
-                    rewritten[o] = None
+                changed = rewritten.delete(so.end-l, so.end)
+                assert not changed, "ERROR: dup remove"
+                removed.delete(so.end-l, so.end)
                 c.tail = start
 
-def trim_tails(root):
+    return removed
+
+def trim_tails(root, standoffs=None, removed=None):
     """
     Trims the beginning of the tail of elements where it is preceded
-    by space.
+    by space. If given, standoffs are for the text before the removals
+    recorded in the RewriteIndex removed (see strip_elements).
     """
 
     # This function is primarily necessary to cover the special case
@@ -314,46 +623,44 @@ def trim_tails(root):
     # to the normal text content-stripping functionality.
 
     # work with standoffs for reference
-    text, standoffs = text_and_standoffs(root)
+    if standoffs is None or removed is None:
+        text, standoffs = text_and_standoffs(root)
+        removed = RewriteIndex(text)
 
     for so in standoffs:
         e = so.element
 
         if (e.tail is not None and e.tail != "" and e.tail[0].isspace() and
-            preceding_space(so.end, text)):
+            removed.preceding_space(so.end)):
             l = 0
             while l < len(e.tail) and e.tail[l].isspace():
                 l += 1
             space, end = e.tail[:l], e.tail[l:]
             e.tail = end
 
-def reduce_space(root, elements_to_strip=set()):
+def reduce_space(root, elements_to_strip=set(), model=None):
     """
-    Performs space-removing normalizations.
+    Performs space-removing normalizations. Returns the TextModel of
+    the tree, updating the given one if any.
     """
 
     # convert tree into text and standoffs for reference
-    text, standoffs = text_and_standoffs(root)
+    if model is None:
+        model = TextModel(root)
+    text, standoffs = model.text, model.standoffs
 
-    strip_elements(root, elements_to_strip, text, standoffs)
+    removed = strip_elements(root, elements_to_strip, text, standoffs)
 
-    trim_tails(root)
+    trim_tails(root, standoffs, removed)
 
     space_normalize(root, text, standoffs)
 
+    model.refresh()
+    return model
+
 def element_in_set(e, s):
-    # strip namespaces for lookup
-    try:
-        if e.tag[0] == "{":
-            tag = re.sub(r'\{.*?\}', '', e.tag)
-        else:
-            tag = e.tag
-    except TypeError:
-        # should only happen for special elements (comments,
-        # processing instructions, and entities)
-        assert not is_standard_element(e), 'internal error'
-        tag = None
-    return tag in s
+    # strip namespaces for lookup (None for special elements)
+    return tags.local_name(e.tag) in s
 
 def read_tree(filename):
     # TODO: portable STDIN input
@@ -368,13 +675,13 @@ def read_tree(filename):
 def process_tree(tree, options=None):
     root = tree.getroot()
 
-    # space normalization and stripping
-    reduce_space(root, strip_element)
+    # space normalization and stripping, keeping the text and
+    # standoffs of the tree up to date
+    model = reduce_space(root, strip_element)
 
     # additional space
 
-    # convert tree into text and standoffs
-    text, standoffs = text_and_standoffs(root)
+    text, standoffs = model.text, model.standoffs
 
     # traverse standoffs and mark each position before which a space
     # or a newline should be assured. Values are (pos, early), where
@@ -383,14 +690,14 @@ def process_tree(tree, options=None):
     # multiple alternative tags before/after which to place the break.
     respace = {}
     for so in standoffs:
-        e = so.element
-        if element_in_set(e, newline_wrap_element):
+        wrap = wrap_space[so.element.tag]
+        if wrap == "\n":
             # "late" newline gets priority
             if not (so.start in respace and (respace[so.start][0] == "\n" and
                                              respace[so.start][1] == False)):
                 respace[so.start] = ("\n", True)
             respace[so.end] = ("\n", False)
-        elif element_in_set(e, space_wrap_element):
+        elif wrap == " ":
             # newlines and "late" get priority
             if not (so.start in respace and (respace[so.start][0] == "\n" or
                                              respace[so.start][1] == False)):
@@ -407,45 +714,40 @@ def process_tree(tree, options=None):
     # expensive computationally.) As the processing is left-to-right,
     # it's enough to use this for preceding positions and to mark
     # inserts as appearing "before" the place where space is required.
-    rewritten = {}
+    rewritten = RewriteIndex(text)
 
     filtered = {}
     for pos in sorted(respace.keys()):
         if respace[pos][0] == " ":
             # unnecessary if initial, terminal, or preceded/followed
             # by a space
-            if not (preceding_space(pos, text, rewritten) or
-                    following_space(pos, text, rewritten)):
+            if not (rewritten.preceding_space(pos) or
+                    rewritten.following_space(pos)):
                 filtered[pos] = respace[pos]
-                rewritten[pos-1] = " "
+                rewritten.rewrite(pos-1, " ")
         else:
             assert respace[pos][0] == "\n", "INTERNAL ERROR"
             # unnecessary if there's either a preceding or following
             # newline connected by space
-            if not (preceding_linebreak(pos, text, rewritten) or 
-                    following_linebreak(pos, text, rewritten)):
-                filtered[pos] = respace[pos]                
-                rewritten[pos-1] = "\n"
+            if not (rewritten.preceding_linebreak(pos) or
+                    rewritten.following_linebreak(pos)):
+                filtered[pos] = respace[pos]
+                rewritten.rewrite(pos-1, "\n")
     respace = filtered
 
-    # for reference, create a map from elements to their parents in the tree.
-    parent_map = {}
-    for parent in root.getiterator():
-        for child in parent:
-            parent_map[child] = parent
-
-    # for reference, create a map from positions to standoffs ending
-    # at each.
-    # TODO: avoid indexing everything; this is only required for
-    # standoffs ending at respace positions
-    end_map = {}
+    # for reference, create a map from positions to the first of the
+    # standoffs with the longest span ending at each (i.e. the
+    # outermost), considering only positions where space is needed.
+    outermost = {}
     for so in standoffs:
-        if so.end not in end_map:
-            end_map[so.end] = []
-        end_map[so.end].append(so)
+        if so.end in respace:
+            o = outermost.get(so.end)
+            if o is None or so.end-so.start > o.end-o.start:
+                outermost[so.end] = so
 
     # traverse standoffs again, adding the new elements as needed.
-    for so in standoffs:
+    inserted = []
+    for j, so in enumerate(standoffs):
         if so.start in respace and respace[so.start][1] == True:
             # Early space needed here. The current node can be assumed
             # to be the first to "discover" this, so it's appropriate
@@ -455,13 +757,12 @@ def process_tree(tree, options=None):
             # node as the preceding child in the parent.
 
             e = so.element
-            assert e in parent_map, "INTERNAL ERROR: add space before root?"
-            p = parent_map[e]
-            i = index_in_parent(e, p)
+            assert e.getparent() is not None, "INTERNAL ERROR: add space before root?"
 
             rse = ET.Element(INSERTED_ELEMENT_TAG)
             rse.text = respace[so.start][0]
-            p.insert(i, rse)
+            e.addprevious(rse)
+            inserted.append((so.start, True, j, rse))
 
             # done, clear
             del respace[so.start]
@@ -470,25 +771,20 @@ def process_tree(tree, options=None):
             # Late space needed here. Add after the current node iff
             # it's the first of the nodes with the longest span ending
             # here (i.e. the outermost).
-            maxlen = max([s.end-s.start for s in end_map[so.end]])
-            if so.end-so.start != maxlen:
-                continue
-            longest = [s for s in end_map[so.end] if s.end-s.start == maxlen]
-            if so != longest[0]:
+            if so is not outermost[so.end]:
                 continue
 
             # OK to add.
             e = so.element
-            assert e in parent_map, "INTERNAL ERROR: add space after root?"
-            p = parent_map[e]
-            i = index_in_parent(e, p)
+            assert e.getparent() is not None, "INTERNAL ERROR: add space after root?"
 
             rse = ET.Element(INSERTED_ELEMENT_TAG)
             rse.text = respace[so.end][0]
-            p.insert(i+1, rse)
+            e.addnext(rse)
             # need to relocate tail
             rse.tail = e.tail
             e.tail = ""
+            inserted.append((so.end, False, j, rse))
 
             # done, clear
             del respace[so.end]
@@ -497,8 +793,9 @@ def process_tree(tree, options=None):
 
     # re-process to clear out consequtive space potentially introduced
     # in previous processing.
-    strip_elements(root)
-    trim_tails(root)
+    model.insert(inserted)
+    removed = strip_elements(root, set(), model.text, model.standoffs)
+    trim_tails(root, model.standoffs, removed)
 
     return tree
 
@@ -2,7 +2,15 @@
 
 # Moves the text content of MathML <annotation> elements into an
 # attribute in XML files, thus removing the annotations from the file
-# text content.
+# text content, and replaces the text content of MathML <math>
+# elements with a linear text rendering of their presentation markup,
+# e.g. x_(i+1) = (a + b)/2 for
+#
+#    <msub><mi>x</mi><mrow><mi>i</mi><mo>+</mo><mn>1</mn></mrow></msub>
+#    <mo>=</mo><mfrac><mrow>...</mrow><mn>2</mn></mfrac>
+#
+# The MathML elements are kept, each holding the rendering of its
+# content, so that their standoffs span their part of the text.
 
 # This is a component in a pipeline to convert PMC NXML files into
 # text and standoffs. The whole pipeline can be run as
@@ -18,6 +26,8 @@ import codecs
 
 from lxml import etree as ET
 
+import tags
+
 # XML tag to use for elements whose text content has been rewritten
 # by this script.
 REWRITTEN_TAG = 'n2t-mmla'
@@ -30,6 +40,60 @@ ORIG_TEXT_ATTRIBUTE = 'orig-text'
 INPUT_ENCODING="UTF-8"
 OUTPUT_ENCODING="UTF-8"
 
+# Whether to replace the content of <math> elements with their linear
+# rendering by default (otherwise the concatenated token text remains)
+LINEARIZE = True
+
+MATHML_NAMESPACE = 'http://www.w3.org/1998/Math/MathML'
+
+# operators rendered with space on both sides when used as infix
+# operators (relations and binary operators)
+SPACED_OPERATORS = set(u'=+-\u2212\u00b1\u2213\u00d7\u00f7<>\u2264\u2265'
+                       u'\u2260\u2248\u2261\u223c\u2243\u221d\u2192'
+                       u'\u2190\u2194\u21d2\u21d0\u21d4\u2208\u2209'
+                       u'\u2282\u2283\u2286\u2287\u222a\u2229\u2227'
+                       u'\u2228\u226a\u226b\u2245\u22c5\u00b7') | \
+    set([u':=', u'<=', u'>=', u'!=', u'==', u'->', u'<-'])
+
+# operators followed by space (separators)
+SEPARATOR_OPERATORS = set([u',', u';'])
+
+# invisible operators; function application is rendered as space
+INVISIBLE_OPERATORS = { u'\u2061': u' ', u'\u2062': u'',
+                        u'\u2063': u'', u'\u2064': u'' }
+
+# accents over a base, rendered as combining characters
+COMBINING_ACCENTS = {
+    u'^': u'\u0302', u'\u02c6': u'\u0302', u'\u0302': u'\u0302',
+    u'~': u'\u0303', u'\u02dc': u'\u0303', u'\u0303': u'\u0303',
+    u'\u00af': u'\u0304', u'\u203e': u'\u0304', u'\u0304': u'\u0304',
+    u'\u02d9': u'\u0307', u'\u0307': u'\u0307',
+    u'\u00a8': u'\u0308', u'\u0308': u'\u0308',
+    u'\u2192': u'\u20d7', u'\u20d7': u'\u20d7',
+}
+
+# elements whose content is not rendered
+IGNORED_ELEMENTS = set(['annotation', 'annotation-xml', 'mphantom',
+                        'mprescripts', 'none', REWRITTEN_TAG])
+
+# annotation elements, left out of the original text of <math>
+ANNOTATION_ELEMENTS = set(['annotation', 'annotation-xml', REWRITTEN_TAG])
+
+# elements whose rendering would run into an adjacent operand, which
+# is separated from it by space (fractions are bracketed instead)
+COMPOUND_ELEMENTS = set(['msqrt', 'mroot', 'msub', 'msup', 'msubsup',
+                         'munder', 'mover', 'munderover',
+                         'mmultiscripts'])
+
+# renderings of accents
+COMBINING_RENDERINGS = set(COMBINING_ACCENTS.values())
+
+SQRT = u'\u221a'
+
+space_re = re.compile(r'\s+')
+# text rendered without brackets as a script or fraction part
+atomic_re = re.compile(r'^(\w+|\w*\.\w+|.)$', re.U)
+
 ##########
 
 def rewrite_element(e, s):
@@ -55,6 +119,391 @@ def rewrite_element(e, s):
     # that's all
     return True
 
+def _localname(e):
+    # None for comments and processing instructions
+    return tags.local_name(e.tag)
+
+def _token(e):
+    return space_re.sub(u' ', u''.join(e.itertext())).strip()
+
+def _text(e):
+    # as _token, but keeping space around words (e.g. in <mtext>)
+    return space_re.sub(u' ', u''.join(e.itertext()))
+
+def _clear(e):
+    """
+    Removes the text content of the given element.
+    """
+
+    for d in e.iter():
+        if d is not e:
+            d.tail = None
+        # comments and processing instructions keep their text
+        if _localname(d) is not None:
+            d.text = None
+
+def _set_text(e, s):
+    """
+    Replaces the text content of the given element with s, returning
+    s.
+    """
+
+    _clear(e)
+    e.text = s or None
+    return s
+
+def _joined(items):
+    return u''.join(i if isinstance(i, basestring) else i[1] for i in items)
+
+def _render(e, items):
+    """
+    Replaces the text content of the given element with a rendering
+    given as a sequence of strings and (child, text) pairs for the
+    children whose content has already been replaced with the text.
+    The children are placed in the order of the rendering and any
+    others are emptied. Returns the text of the rendering.
+    """
+
+    rendered = set(i[0] for i in items if not isinstance(i, basestring))
+    for c in e:
+        if c not in rendered:
+            _clear(c)
+        c.tail = None
+
+    e.text = None
+    previous, pending = None, []
+    for i in items:
+        if isinstance(i, basestring):
+            pending.append(i)
+            continue
+        _place(e, previous, u''.join(pending))
+        e.append(i[0])
+        previous, pending = i[0], []
+    _place(e, previous, u''.join(pending))
+
+    return _joined(items)
+
+def _place(e, previous, s):
+    # text following the previous child of e, or starting e
+    if previous is None:
+        e.text = s or None
+    else:
+        previous.tail = s or None
+
+def _text_slots(e):
+    """
+    Generates (element, is_tail) pairs for the texts and tails under
+    the given element in document order.
+    """
+
+    if _localname(e) is not None:
+        yield e, False
+    for c in e:
+        for slot in _text_slots(c):
+            yield slot
+        yield c, True
+
+def _collapse_space(e):
+    """
+    Replaces space in the text content of the given element with
+    single spaces, removing space at its start and end.
+    """
+
+    # start as if following space, to remove space at the start
+    space, last = True, None
+    for d, is_tail in _text_slots(e):
+        s = d.tail if is_tail else d.text
+        if not s:
+            continue
+        s = space_re.sub(u' ', s)
+        if space and s[0] == u' ':
+            s = s[1:]
+        if s:
+            space, last = s[-1] == u' ', (d, is_tail)
+        _set_slot(d, is_tail, s)
+    if space and last is not None:
+        d, is_tail = last
+        _set_slot(d, is_tail, (d.tail if is_tail else d.text)[:-1])
+
+def _set_slot(e, is_tail, s):
+    if is_tail:
+        e.tail = s or None
+    else:
+        e.text = s or None
+
+def _bracketed(s):
+    """
+    Returns whether s is enclosed in a single pair of parentheses.
+    """
+
+    if not (s.startswith(u'(') and s.endswith(u')')):
+        return False
+    depth = 0
+    for i, c in enumerate(s):
+        if c == u'(':
+            depth += 1
+        elif c == u')':
+            depth -= 1
+            if depth == 0 and i != len(s)-1:
+                return False
+    return True
+
+def _group(items):
+    """
+    Returns the given rendering bracketed unless it is a single item.
+    """
+
+    s = _joined(items)
+    if atomic_re.match(s) or _bracketed(s):
+        return items
+    return [u'('] + items + [u')']
+
+def _enclosed(items):
+    """
+    Returns the given rendering bracketed unless it already is.
+    """
+
+    if _bracketed(_joined(items)):
+        return items
+    return [u'('] + items + [u')']
+
+def _script(base, sub, sup):
+    """
+    Returns the rendering of the given base rendering with the
+    given (child, text) subscript and superscript pairs, if any.
+    """
+
+    items = list(base)
+    if sub is not None and sub[1]:
+        items += [u'_'] + _group([sub])
+    if sup is not None and sup[1]:
+        items += [u'^'] + _group([sup])
+    return items
+
+def _children(e):
+    return [c for c in e if _localname(c) is not None]
+
+def _operator(e, prefix):
+    op = _token(e)
+    if op in INVISIBLE_OPERATORS:
+        return INVISIBLE_OPERATORS[op]
+    form = e.get('form')
+    if form == 'prefix' or (prefix and form is None):
+        return op
+    elif op in SPACED_OPERATORS:
+        return u' ' + op + u' '
+    elif op in SEPARATOR_OPERATORS:
+        return op + u' '
+    else:
+        return op
+
+def _compound(c, s):
+    """
+    Returns whether the given rendering s of the element c would run
+    into an adjacent operand.
+    """
+
+    # accented symbols (mover) are rendered as single characters
+    return _localname(c) in COMPOUND_ELEMENTS and \
+        s[-1:] not in COMBINING_RENDERINGS
+
+def _operand(rendered, i, step):
+    """
+    Returns the (child, text) pair of the operand adjacent to the one
+    at i in the given row renderings in the direction of step, or None
+    if separated from it by a visible operator or the end of the row.
+    """
+
+    i += step
+    while 0 <= i < len(rendered):
+        c, s, op = rendered[i]
+        if op is None:
+            return c, s
+        elif s != u'':
+            return None
+        i += step
+    return None
+
+def _row(children):
+    """
+    Returns the linear rendering of a sequence of MathML elements.
+    """
+
+    # (child, rendering, operator or None for operands) triples
+    rendered = []
+    # an operator is used as prefix at the start of a row or after
+    # another operator (other than a closing fence)
+    prefix = True
+    for c in children:
+        if _localname(c) == 'mo':
+            s = _operator(c, prefix)
+            op = s.strip()
+            prefix = op not in (u')', u']', u'}', u'|', u'\u232a', u'\u27e9')
+            rendered.append((c, s, op))
+        else:
+            rendered.append((c, linearize(c), None))
+            prefix = False
+
+    items = []
+    previous = None
+    for i, (c, s, op) in enumerate(rendered):
+        if op is not None:
+            # space around the operator goes outside the element
+            before = len(s) - len(s.lstrip())
+            items.extend([s[:before], (c, _set_text(c, op)),
+                          s[before+len(op):]])
+            previous = c
+            continue
+
+        # separate multi-letter identifiers ("sin x") and fractions,
+        # roots and scripts from adjacent operands ("(1/n) sum_i x_i")
+        adjacent = _operand(rendered, i, -1)
+        if previous is not None and _localname(previous) == 'mi' and \
+                len(_token(previous)) > 1 and s[:1].isalnum():
+            items.append(u' ')
+        elif adjacent is not None and \
+                (_compound(*adjacent) or _compound(c, s)) and \
+                not _joined(items).endswith(u' ') and s[:1] != u' ':
+            items.append(u' ')
+
+        if _localname(c) == 'mfrac' and \
+                (adjacent is not None or _operand(rendered, i, 1) is not None):
+            items.extend([u'(', (c, s), u')'])
+        else:
+            items.append((c, s))
+        previous = c
+    return items
+
+def _separated(children, separator):
+    items = []
+    for i, c in enumerate(children):
+        if i > 0:
+            items.append(separator)
+        items.append((c, linearize(c)))
+    return items
+
+def linearize(e):
+    """
+    Replaces the text content of the given presentation MathML element
+    with a linear text rendering, returning the rendering.
+    """
+
+    name = _localname(e)
+    children = _children(e)
+
+    if name is None:
+        return u''
+    elif name in IGNORED_ELEMENTS:
+        return _set_text(e, u'')
+    elif name in ('mi', 'mn'):
+        return _set_text(e, _token(e))
+    elif name == 'mtext':
+        return _set_text(e, _text(e))
+    elif name == 'ms':
+        return _set_text(e, u'"' + _token(e) + u'"')
+    elif name == 'mo':
+        return _set_text(e, _operator(e, True))
+    elif name == 'mspace':
+        return _set_text(e, u' ')
+    elif name == 'mglyph':
+        return _set_text(e, e.get('alt', u''))
+    elif name == 'mfrac' and len(children) == 2:
+        numerator, denominator = [(c, linearize(c)) for c in children]
+        return _render(e, _group([numerator]) + [u'/'] +
+                       _group([denominator]))
+    elif name == 'msqrt':
+        return _render(e, [SQRT] + _enclosed(_row(children)))
+    elif name == 'mroot' and len(children) == 2:
+        # the index comes first in the rendering, as in TeX
+        base, index = [(c, linearize(c)) for c in children]
+        return _render(e, [SQRT, u'[', index, u']'] + _enclosed([base]))
+    elif name in ('msub', 'munder') and len(children) == 2:
+        base, sub = [(c, linearize(c)) for c in children]
+        items = _script([base], sub, None)
+        if _localname(children[0]) == 'mo':
+            items.append(u' ')
+        return _render(e, items)
+    elif name == 'msup' and len(children) == 2:
+        base, sup = [(c, linearize(c)) for c in children]
+        return _render(e, _script([base], None, sup))
+    elif name == 'mover' and len(children) == 2:
+        base, over = [(c, linearize(c)) for c in children]
+        accent = COMBINING_ACCENTS.get(over[1].strip())
+        if accent is not None and len(base[1]) == 1:
+            return _render(e, [base, (over[0], _set_text(over[0], accent))])
+        return _render(e, _script([base], None, over))
+    elif name in ('msubsup', 'munderover') and len(children) == 3:
+        base, sub, sup = [(c, linearize(c)) for c in children]
+        items = _script([base], sub, sup)
+        # separate the operand of large operators ("sum_(i = 1)^n x")
+        if _localname(children[0]) == 'mo':
+            items.append(u' ')
+        return _render(e, items)
+    elif name == 'mmultiscripts' and children:
+        # postscripts only, in (subscript, superscript) pairs
+        scripts = []
+        for c in children[1:]:
+            if _localname(c) == 'mprescripts':
+                break
+            scripts.append((c, linearize(c)))
+        items = [(children[0], linearize(children[0]))]
+        for i in range(0, len(scripts)-1, 2):
+            items = _script(items, scripts[i], scripts[i+1])
+        return _render(e, items)
+    elif name == 'mfenced':
+        separators = space_re.sub(u'', e.get('separators', u','))
+        items = [e.get('open', u'(')]
+        for i, c in enumerate(children):
+            if i > 0 and separators:
+                items.append(separators[min(i-1, len(separators)-1)] + u' ')
+            items.append((c, linearize(c)))
+        items.append(e.get('close', u')'))
+        return _render(e, items)
+    elif name == 'mtable':
+        return _render(e, _separated(children, u'; '))
+    elif name in ('mtr', 'mlabeledtr'):
+        return _render(e, _separated(children, u', '))
+    elif name in ('semantics', 'maction') and children:
+        # the first child is the presentation (or selected) markup
+        return _render(e, [(children[0], linearize(children[0]))])
+    else:
+        # math, mrow, mstyle, mpadded, menclose, merror, mtd etc.
+        return _render(e, _row(children))
+
+def rewrite_math(e):
+    """
+    Given a MathML <math> element, replaces its text content with a
+    linear text rendering, storing the original text content and tag
+    as for rewrite_element().
+    """
+
+    for a in (ORIG_TAG_ATTRIBUTE, ORIG_TEXT_ATTRIBUTE):
+        assert a not in e.attrib, "rewritemmla: error: attribute '%s' already defined!" % a
+
+    e.attrib[ORIG_TEXT_ATTRIBUTE] = _presentation_text(e)
+    e.attrib[ORIG_TAG_ATTRIBUTE] = e.tag
+
+    linearize(e)
+    _collapse_space(e)
+    e.tag = REWRITTEN_TAG
+
+    return True
+
+def _presentation_text(e):
+    """
+    Returns the text content of the given element, leaving out that
+    of annotations.
+    """
+
+    name = _localname(e)
+    if name in ANNOTATION_ELEMENTS:
+        return u''
+    parts = [e.text or u''] if name is not None else []
+    for c in e:
+        parts.append(_presentation_text(c))
+        parts.append(c.tail or u'')
+    return u''.join(parts)
+
 def read_tree(filename):
     try:
         return ET.parse(filename)
@@ -62,16 +511,33 @@ def read_tree(filename):
         print >> sys.stderr, "Error parsing %s" % fn
         raise
 
-def process_tree(tree, options=None):
+def process_tree(tree, options=None, math=None, annotations=None):
+    """
+    Rewrites the given MathML "math" and "annotation" elements of
+    the tree, or all of them if not given.
+    """
+
     root = tree.getroot()
 
-    namespaces = { 'mml': 'http://www.w3.org/1998/Math/MathML' }
+    namespaces = { 'mml': MATHML_NAMESPACE }
 
     # find "annotation" elements in any the namespace
-    # http://www.w3.org/1998/Math/MathML anywhere in the tree.
-    for e in root.xpath("//mml:annotation", namespaces=namespaces):
+    # http://www.w3.org/1998/Math/MathML anywhere in the tree. These
+    # are rewritten first, so that the rendering of "math" elements
+    # leaves them out.
+    if annotations is None:
+        annotations = root.xpath("//mml:annotation", namespaces=namespaces)
+    for e in annotations:
         rewrite_element(e, '')
 
+    # replace the content of "math" elements with their linear
+    # rendering
+    if getattr(options, 'linearize', LINEARIZE):
+        if math is None:
+            math = root.xpath("//mml:math", namespaces=namespaces)
+        for e in math:
+            rewrite_math(e)
+
     return tree
 
 def write_tree(tree, options=None):
@@ -102,14 +568,15 @@ def write_tree(tree, options=None):
 
 def process(fn, options=None):
     tree = read_tree(fn)
-    process_tree(tree)
+    process_tree(tree, options)
     write_tree(tree, options)
 
 def argparser():
     import argparse
-    ap=argparse.ArgumentParser(description='Mask MathML <annotation> element text content in XML files.')
+    ap=argparse.ArgumentParser(description='Mask MathML <annotation> element text content and linearize MathML <math> elements in XML files.')
     ap.add_argument('-d', '--directory', default=None, metavar='DIR', help='output directory')
     ap.add_argument('-o', '--overwrite', default=False, action='store_true', help='allow output to overwrite input files')
+    ap.add_argument('-r', '--raw', dest='linearize', default=LINEARIZE, action='store_false', help='keep the token text of <math> elements instead of linearizing them')
     ap.add_argument('-s', '--stdout', default=False, action='store_true', help='output to stdout')
     ap.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output')
     ap.add_argument('file', nargs='+', help='input XML file')
@@ -14,12 +14,38 @@ import sys
 import os
 import re
 import codecs
+import time
+import signal
+import threading
 
 from lxml import etree as ET
 
+import texmath
+
 # How many seconds to wait for a SQLite lock to go away.
 SQLITE_TIMEOUT = 30.0
 
+# How many new SQLite cache entries to buffer before writing them in
+# a single transaction.
+SQLITE_COMMIT_INTERVAL = 100
+
+# Maximum number of keys to look up in a single SQLite query (kept
+# below the default SQLite limit of 999 host parameters).
+SQLITE_MAX_VARIABLES = 500
+
+# Whether to count lookups of each cache entry in the SQLite cache
+# (for the hit frequency statistics of texcache). Off by default, as
+# counting adds a database write for each formula looked up. Lookups
+# are counted where they enter the cache (see get_cache()), including
+# those answered from memory or a snapshot.
+SQLITE_COUNT_HITS = False
+
+# Limits on the number of entries and their total size in bytes in
+# the in-memory cache of recently used tex -> text mappings kept in
+# front of the on-disk cache.
+LRU_MAX_ENTRIES = 20000
+LRU_MAX_BYTES = 32 * 1024 * 1024
+
 # XML tag to use for elements whose text content has been rewritten
 # by this script.
 REWRITTEN_TAG = 'n2t-tex'
@@ -31,21 +57,86 @@ ORIG_TEXT_ATTRIBUTE = 'orig-text'
 
 # command for invoking tex (-interaction=nonstopmode makes latex try
 # to proceed on error without waiting for input.)
-TEX_COMMAND = 'latex -interaction=nonstopmode'
+TEX_COMMAND = ['latex', '-interaction=nonstopmode']
+
+# command for dumping a tex format: latex starts from its own format
+# ("&latex"), reads the preamble and dumps the result.
+TEX_INI_COMMAND = ['latex', '-ini', '-interaction=nonstopmode']
+
+# seconds after which a tex or catdvi process is killed
+TEX_TIMEOUT = 10.0
+
+# additional seconds allowed for each formula in a batched tex document
+TEX_BATCH_TIMEOUT = 0.5
+
+# seconds allowed for dumping a tex format
+TEX_FORMAT_TIMEOUT = 60.0
+
+# total seconds of tex conversion allowed for a single NXML document,
+# after which its remaining formulas are left unconverted
+TEX_BUDGET = 120.0
+
+# whether to compile documents with standard preambles (see
+# tex_format()) using precompiled formats holding the preamble
+TEX_FORMATS = True
+
+# directory for precompiled tex formats
+TEX_FORMAT_DIR = os.path.join(os.path.dirname(__file__), '../data/texfmt')
+
+# directory in which to create the private scratch directory of each
+# conversion, into which tex places its output (None for the system
+# default, e.g. /tmp).
+TEX_TMPDIR = None
+
+# number of tex conversions to run concurrently for a document
+TEX_JOBS = 1
+
+# whether to convert formulas in the subset of tex supported by
+# texmath in-process instead of invoking tex and catdvi
+TEXMATH = True
 
-# directory into which to instruct tex to place its output.
-TEX_OUTPUTDIR = '/tmp'
+# maximum number of formulas to compile together in one tex document
+# (see tex2str_batch(); 1 disables batching)
+TEX_BATCH_SIZE = 50
+
+# text marking the start of each formula in batched tex documents,
+# formatted with the index of the formula. (Capitals and digits only,
+# to avoid ligatures in catdvi output.)
+TEX_BATCH_MARKER = 'NXMLTXTFORMULA%dNXMLTXTMARK'
+
+# reasons for failed conversions: tex produced no output, catdvi
+# produced no text, or either timed out. Formulas left unconverted for
+# lack of time in the document budget are marked with FAILURE_BUDGET.
+FAILURE_COMPILE = 'compile'
+FAILURE_EMPTY = 'empty'
+FAILURE_TIMEOUT = 'timeout'
+FAILURE_BUDGET = 'budget'
+
+# reasons that depend on the load of the machine rather than on the
+# formula; these are not recorded, so that the formulas are retried
+TRANSIENT_FAILURES = set([FAILURE_TIMEOUT, FAILURE_BUDGET])
 
 # command for invokind catdvi (-e 0 specifies output encoding in UTF-8,
 # and -s sets sequential mode, which turns off attempt to reproduce
 # layout such as sub- and superscript positioning.)
-CATDVI_COMMAND = 'catdvi -e 0 -s'
+CATDVI_COMMAND = ['catdvi', '-e', '0', '-s']
 
 # path to on-disk caches of tex document -> text mappings
 PICKLE_CACHE_PATH = os.path.join(os.path.dirname(__file__),
                                  '../data/tex2txt.cache')
 SQLITE_CACHE_PATH = os.path.join(os.path.dirname(__file__),
                                  '../data/tex2txt.db')
+SNAPSHOT_CACHE_PATH = os.path.join(os.path.dirname(__file__),
+                                   '../data/tex2txt.snap')
+
+# snapshot file layout (see SnapshotCache): header of magic string,
+# format version and entry count, followed by an index of entries
+# sorted by key hash giving the offsets and lengths of the key and
+# value of each in the UTF-8 blob that follows.
+SNAPSHOT_MAGIC = 'N2TSNAP\0'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = '<8sII'
+SNAPSHOT_ENTRY = '<QIIII'
 
 INPUT_ENCODING="UTF-8"
 OUTPUT_ENCODING="UTF-8"
@@ -58,6 +149,13 @@ texdecl_re = re.compile(r'(\\(?:documentclass|usepackage|setlength|pagestyle)(?:
 texdoc_re = re.compile(r'(\\(?:begin|end)(?:\[[^\[\]]*\])?\{document\})')
 # includes for "standard" tex packages
 texstdpack_re = re.compile(r'\\usepackage\{(?:amsbsy|amsfonts|amsmath|amssymb|mathrsfs|upgreek|wasysym)\}')
+# document body
+texbody_re = re.compile(r'\\begin(?:\[[^\[\]]*\])?\{document\}(.*)\\end(?:\[[^\[\]]*\])?\{document\}', re.S)
+# formula markers in output for batched tex documents
+texmarker_re = re.compile(TEX_BATCH_MARKER.replace('%d', r'(\d+)'))
+# tex error messages and the input line numbers they refer to
+texerror_re = re.compile(r'^!', re.M)
+texerrorline_re = re.compile(r'^l\.(\d+)', re.M)
 # consequtive space
 space_re = re.compile(r'\s+')
 # initial and terminal space.
@@ -128,12 +226,78 @@ class Cache(object):
             self._map = {}
         else:
             self._map = map_
+        # failed conversions, key -> [reason, toolchain, count]
+        self._failed = {}
 
     def get(self, key):
         return self._map.get(key)
 
+    def add_hits(self, key, count=1):
+        """
+        Records count lookups of the given key; kept only by the SQLite
+        cache.
+        """
+
+        pass
+
+    def items(self):
+        """
+        Generates the (key, value) pairs of all entries in the cache.
+        """
+
+        return self._map.iteritems()
+
+    def get_many(self, keys):
+        """
+        Returns a dict mapping those of the given keys that are found
+        in the cache to their values.
+        """
+
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
     def set(self, key, value):
         self._map[key] = value
+        self._failed.pop(key, None)
+
+    def get_failures(self, keys):
+        """
+        Returns a dict mapping those of the given keys that are
+        recorded as failed conversions to (reason, toolchain, count)
+        tuples.
+        """
+
+        return dict((k, tuple(self._failed[k])) for k in keys
+                    if k in self._failed)
+
+    def add_failure(self, key, reason, toolchain, count=1):
+        """
+        Records count failed conversions of the given key by the given
+        tex toolchain (see tex_toolchain()).
+        """
+
+        if key in self._failed:
+            self._failed[key][:2] = [reason, toolchain]
+            self._failed[key][2] += count
+        else:
+            self._failed[key] = [reason, toolchain, count]
+
+    def failures(self, n):
+        """
+        Returns (key, reason, toolchain, count) tuples for the n
+        most frequent failed conversions.
+        """
+
+        failed = [(k,) + tuple(v) for k, v in self._failed.items()]
+        failed.sort(key=lambda f: -f[3])
+        return failed[:n]
+
+    def flush(self):
+        pass
 
 class PickleCache(Cache):
     def __init__(self, map=None):
@@ -170,11 +334,19 @@ class PickleCache(Cache):
             raise
 
 class SqliteCache(Cache):
-    def __init__(self, db=None):
+    def __init__(self, db=None, commit_interval=SQLITE_COMMIT_INTERVAL):
         super(SqliteCache, self).__init__(None)
         self.db = db
+        self.commit_interval = commit_interval
+        # entries set but not yet written to the database
+        self.pending = {}
+        self.pending_failed = {}
+        # lookup counts not yet written to the database
+        self.pending_hits = {}
 
     def get(self, key):
+        if key in self.pending:
+            return self.pending[key]
         cursor = self.db.cursor()
         cursor.execute('SELECT txt FROM tex2txt WHERE tex = ?', (key,))
         row = cursor.fetchone()
@@ -184,52 +356,641 @@ class SqliteCache(Cache):
         else:
             return row[0]
 
+    def get_many(self, keys):
+        found = {}
+        remaining = []
+        for key in set(keys):
+            if key in self.pending:
+                found[key] = self.pending[key]
+            else:
+                remaining.append(key)
+
+        cursor = self.db.cursor()
+        for i in range(0, len(remaining), SQLITE_MAX_VARIABLES):
+            chunk = remaining[i:i+SQLITE_MAX_VARIABLES]
+            cursor.execute('SELECT tex, txt FROM tex2txt WHERE tex IN (%s)' %
+                           ','.join('?' * len(chunk)), chunk)
+            found.update(cursor.fetchall())
+        cursor.close()
+        return found
+
+    def items(self):
+        self.flush()
+        cursor = self.db.cursor()
+        cursor.execute('SELECT tex, txt FROM tex2txt')
+        for row in cursor:
+            yield row
+        cursor.close()
+
     def set(self, key, value):
+        self.pending[key] = value
+        self.pending_failed.pop(key, None)
+        self._flush_if_full()
+
+    def hits(self):
+        """
+        Returns (key, count) pairs giving the number of lookups of
+        each entry that were answered by this cache.
+        """
+
+        self.flush()
+        cursor = self.db.cursor()
+        # caches opened read-only may predate hit counting
+        cursor.execute("SELECT name FROM sqlite_master"
+                       "  WHERE type = 'table' AND name = 'tex2txt_hits'")
+        if cursor.fetchone() is not None:
+            cursor.execute('SELECT tex, hits FROM tex2txt_hits')
+            for row in cursor:
+                yield row
+        cursor.close()
+
+    def add_hits(self, key, count=1):
+        self.pending_hits[key] = self.pending_hits.get(key, 0) + count
+
+    def get_failures(self, keys):
+        found = {}
+        cursor = self.db.cursor()
+        keys = list(set(keys))
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            chunk = keys[i:i+SQLITE_MAX_VARIABLES]
+            cursor.execute('SELECT tex, reason, toolchain, count'
+                           '  FROM tex2txt_failed WHERE tex IN (%s)' %
+                           ','.join('?' * len(chunk)), chunk)
+            for key, reason, toolchain, count in cursor.fetchall():
+                found[key] = (reason, toolchain, count)
+        cursor.close()
+
+        for key in keys:
+            if key in self.pending_failed:
+                reason, toolchain, count = self.pending_failed[key]
+                count += found.get(key, (None, None, 0))[2]
+                found[key] = (reason, toolchain, count)
+        return found
+
+    def add_failure(self, key, reason, toolchain, count=1):
+        if key in self.pending_failed:
+            count += self.pending_failed[key][2]
+        self.pending_failed[key] = (reason, toolchain, count)
+        self._flush_if_full()
+
+    def failures(self, n):
+        self.flush()
         cursor = self.db.cursor()
-        cursor.execute('INSERT OR REPLACE INTO tex2txt VALUES (?,?)',
-                       (key, value))
+        cursor.execute('SELECT tex, reason, toolchain, count'
+                       '  FROM tex2txt_failed ORDER BY count DESC LIMIT ?',
+                       (n,))
+        failed = cursor.fetchall()
+        cursor.close()
+        return failed
+
+    def _flush_if_full(self):
+        if len(self.pending) + len(self.pending_failed) >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes buffered entries to the database in one transaction.
+        """
+
+        if not self.pending and not self.pending_failed and not self.pending_hits:
+            return
+        cursor = self.db.cursor()
+        cursor.executemany('INSERT OR REPLACE INTO tex2txt VALUES (?,?)',
+                           self.pending.items())
+        # successful conversions replace any recorded failures
+        cursor.executemany('DELETE FROM tex2txt_failed WHERE tex = ?',
+                           [(k,) for k in self.pending])
+        cursor.executemany('INSERT OR IGNORE INTO tex2txt_failed'
+                           '  VALUES (?,?,?,0)',
+                           [(k, r, t) for k, (r, t, c)
+                            in self.pending_failed.items()])
+        cursor.executemany('UPDATE tex2txt_failed'
+                           '  SET reason = ?, toolchain = ?, count = count + ?'
+                           '  WHERE tex = ?',
+                           [(r, t, c, k) for k, (r, t, c)
+                            in self.pending_failed.items()])
+        cursor.executemany('INSERT OR IGNORE INTO tex2txt_hits VALUES (?,0)',
+                           [(k,) for k in self.pending_hits])
+        cursor.executemany('UPDATE tex2txt_hits SET hits = hits + ?'
+                           '  WHERE tex = ?',
+                           [(c, k) for k, c in self.pending_hits.items()])
         self.db.commit()
         cursor.close()
+        self.pending = {}
+        self.pending_failed = {}
+        self.pending_hits = {}
 
     def save(self):
+        self.flush()
         self.db.close()
         self.db = None
 
     @classmethod
-    def load(cls, filename=SQLITE_CACHE_PATH):
+    def load(cls, filename=SQLITE_CACHE_PATH, readonly=False):
+        """
+        Opens the SQLite cache in the given file, creating it unless
+        readonly, in which case the file is left unchanged.
+        """
+
         import sqlite3
+        if readonly:
+            from urllib import quote
+            uri = 'file:%s?mode=ro' % quote(os.path.abspath(filename))
+            db = sqlite3.connect(uri, timeout=SQLITE_TIMEOUT)
+            db.execute('PRAGMA query_only=ON')
+            return cls(db)
+
         db = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT)
-        # make sure the map table exists
         cursor = db.cursor()
+        # with a write-ahead log, readers do not block the writer, so
+        # that many processes can share the cache. Commits need not
+        # be synced to disk, as the cache can always be rebuilt.
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        # make sure the map table exists
         cursor.execute('CREATE TABLE IF NOT EXISTS'
                        '  tex2txt(tex TEXT PRIMARY KEY, txt TEXT)')
+        cursor.execute('CREATE TABLE IF NOT EXISTS'
+                       '  tex2txt_failed(tex TEXT PRIMARY KEY, reason TEXT,'
+                       '                 toolchain TEXT, count INTEGER)')
+        cursor.execute('CREATE TABLE IF NOT EXISTS'
+                       '  tex2txt_hits(tex TEXT PRIMARY KEY, hits INTEGER)')
         db.commit()
         cursor.close()
         return cls(db)
 
-def get_cache(cls=SqliteCache):
+class LRUCache(Cache):
+    """
+    Size-bounded in-memory cache of recently used entries in front of
+    another cache, which holds all entries.
+    """
+
+    def __init__(self, backing, max_entries=LRU_MAX_ENTRIES,
+                 max_bytes=LRU_MAX_BYTES, count_hits=False):
+        from collections import OrderedDict
+        super(LRUCache, self).__init__(OrderedDict())
+        self.backing = backing
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # whether to record lookups of found entries in the backing
+        # cache (see SQLITE_COUNT_HITS)
+        self.count_hits = count_hits
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def counters(self):
+        return (self.hits, self.misses, self.evictions)
+
+    def _add(self, key, value):
+        old = self._map.pop(key, None)
+        if old is not None:
+            self.bytes -= sys.getsizeof(key) + sys.getsizeof(old)
+        self._map[key] = value
+        self.bytes += sys.getsizeof(key) + sys.getsizeof(value)
+
+        # evict least recently used entries
+        while self._map and (len(self._map) > self.max_entries or
+                             self.bytes > self.max_bytes):
+            key, value = self._map.popitem(last=False)
+            self.bytes -= sys.getsizeof(key) + sys.getsizeof(value)
+            self.evictions += 1
+
+    def _lookup(self, key):
+        value = self._map.pop(key, None)
+        if value is not None:
+            # mark as most recently used
+            self._map[key] = value
+        return value
+
+    def get(self, key):
+        value = self._lookup(key)
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            value = self.backing.get(key)
+            if value is not None:
+                self._add(key, value)
+        if value is not None and self.count_hits:
+            self.backing.add_hits(key)
+        return value
+
+    def get_many(self, keys):
+        found, remaining = {}, []
+        for key in set(keys):
+            value = self._lookup(key)
+            if value is not None:
+                found[key] = value
+            else:
+                remaining.append(key)
+
+        self.hits += len(found)
+        self.misses += len(remaining)
+        if remaining:
+            for key, value in self.backing.get_many(remaining).items():
+                self._add(key, value)
+                found[key] = value
+        if self.count_hits:
+            for key in found:
+                self.backing.add_hits(key)
+        return found
+
+    def set(self, key, value):
+        self.backing.set(key, value)
+        self._add(key, value)
+
+    def add_hits(self, key, count=1):
+        self.backing.add_hits(key, count)
+
+    def get_failures(self, keys):
+        return self.backing.get_failures(keys)
+
+    def add_failure(self, key, reason, toolchain, count=1):
+        self.backing.add_failure(key, reason, toolchain, count)
+
+    def failures(self, n):
+        return self.backing.failures(n)
+
+    def flush(self):
+        self.backing.flush()
+
+    def save(self):
+        self.backing.save()
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+def _key_hash(key):
+    from hashlib import sha1
+    from struct import unpack
+    return unpack('<Q', sha1(_utf8(key)).digest()[:8])[0]
+
+class SnapshotCache(Cache):
+    """
+    Immutable snapshot of a cache in a file that is memory-mapped
+    rather than read, so that opening it takes no time and all
+    processes using it share one copy in the page cache. Lookups are
+    by binary search over an index sorted by key hash. Entries not in
+    the snapshot are looked up in and added to the given backing
+    cache.
+    """
+
+    def __init__(self, mapped, backing=None):
+        from struct import calcsize, unpack_from
+        super(SnapshotCache, self).__init__(None)
+        self.mapped = mapped
+        self.backing = backing if backing is not None else Cache()
+
+        magic, version, self.count = unpack_from(SNAPSHOT_HEADER, mapped)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('not a tex2txt snapshot (version %d)' %
+                             SNAPSHOT_VERSION)
+        self.index = calcsize(SNAPSHOT_HEADER)
+        self.entry_size = calcsize(SNAPSHOT_ENTRY)
+        self.blob = self.index + self.count * self.entry_size
+
+    def _entry(self, i):
+        from struct import unpack_from
+        return unpack_from(SNAPSHOT_ENTRY, self.mapped,
+                           self.index + i * self.entry_size)
+
+    def _string(self, offset, length):
+        start = self.blob + offset
+        return self.mapped[start:start+length].decode('utf-8')
+
+    def lookup(self, key):
+        """
+        Returns the value for the given key in the snapshot, or None
+        if it is not included.
+        """
+
+        h, key = _key_hash(key), _utf8(key)
+
+        # find the first entry with the hash
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # compare keys of entries with the hash
+        for i in xrange(lo, self.count):
+            entry_hash, koff, klen, voff, vlen = self._entry(i)
+            if entry_hash != h:
+                break
+            start = self.blob + koff
+            if klen == len(key) and self.mapped[start:start+klen] == key:
+                return self._string(voff, vlen)
+        return None
+
+    def get(self, key):
+        value = self.lookup(key)
+        if value is not None:
+            return value
+        return self.backing.get(key)
+
+    def get_many(self, keys):
+        found, remaining = {}, []
+        for key in set(keys):
+            value = self.lookup(key)
+            if value is not None:
+                found[key] = value
+            else:
+                remaining.append(key)
+        if remaining:
+            found.update(self.backing.get_many(remaining))
+        return found
+
+    def items(self):
+        for i in xrange(self.count):
+            entry_hash, koff, klen, voff, vlen = self._entry(i)
+            yield self._string(koff, klen), self._string(voff, vlen)
+
+    def set(self, key, value):
+        self.backing.set(key, value)
+
+    def add_hits(self, key, count=1):
+        self.backing.add_hits(key, count)
+
+    def get_failures(self, keys):
+        return self.backing.get_failures(keys)
+
+    def add_failure(self, key, reason, toolchain, count=1):
+        self.backing.add_failure(key, reason, toolchain, count)
+
+    def failures(self, n):
+        return self.backing.failures(n)
+
+    def flush(self):
+        self.backing.flush()
+
+    def save(self):
+        if hasattr(self.backing, 'save'):
+            self.backing.save()
+
+    @classmethod
+    def load(cls, filename=SNAPSHOT_CACHE_PATH, backing=None):
+        import mmap
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, backing)
+
+    @staticmethod
+    def write(items, filename=SNAPSHOT_CACHE_PATH):
+        """
+        Writes a snapshot of the given (key, value) pairs into the
+        given file. Returns the number of entries written.
+        """
+
+        from struct import pack
+
+        entries = []
+        for key, value in items:
+            key, value = _utf8(key), _utf8(value)
+            entries.append((_key_hash(key), key, value))
+        entries.sort()
+
+        index, blob, offset = [], [], 0
+        for h, key, value in entries:
+            index.append(pack(SNAPSHOT_ENTRY, h, offset, len(key),
+                              offset + len(key), len(value)))
+            blob.extend((key, value))
+            offset += len(key) + len(value)
+        if offset >= 2**32:
+            raise ValueError('snapshot too large')
+
+        # write next to the target and move in place, so that
+        # processes with the old snapshot mapped are not affected
+        tmpfn = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            with open(tmpfn, 'wb') as f:
+                f.write(pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC,
+                             SNAPSHOT_VERSION, len(entries)))
+                f.write(''.join(index))
+                f.write(''.join(blob))
+            os.rename(tmpfn, filename)
+        finally:
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+        return len(entries)
+
+def get_cache(cls=SqliteCache, count_hits=None):
+    """
+    Returns the cache used for conversions: the given cache, behind
+    the snapshot if any and an in-memory cache of recently used
+    entries. Lookups are counted if count_hits is True, or if None and
+    SQLITE_COUNT_HITS is set.
+    """
+
+    if count_hits is None:
+        count_hits = SQLITE_COUNT_HITS
     try:
-        return cls.load()
+        cache = cls.load()
     except Exception, e:
         print >> sys.stderr, 'Warning: %s load failed: %s' % (str(cls), str(e))
-        return cls()
+        cache = cls()
+
+    # a snapshot, if any, is shared with other processes
+    if os.path.exists(SNAPSHOT_CACHE_PATH):
+        try:
+            cache = SnapshotCache.load(SNAPSHOT_CACHE_PATH, cache)
+        except Exception, e:
+            print >> sys.stderr, 'Warning: snapshot load failed: %s' % str(e)
 
-def tex_compile(fn):
+    return LRUCache(cache, count_hits=count_hits)
+
+class TexTimeout(Exception):
     """
-    Invokes tex to compile the file with the given name.  
-    Returns the name of the output file (.dvi), the empty string if
-    the name could not be determined, or None if compilation fails.
+    Raised when an external command is killed for running too long.
+    """
+    pass
+
+def run_command(args, cwd=None, timeout=None):
+    """
+    Runs the given command (without a shell) in a new process group,
+    returning its (stdout, stderr). If the command runs longer than
+    timeout seconds, kills the whole process group, so that also any
+    programs started by the command are stopped, and raises
+    TexTimeout.
     """
 
     from subprocess import PIPE, Popen
 
-    cmd = TEX_COMMAND+' '+'-output-directory='+TEX_OUTPUTDIR+' '+fn
+    # (close_fds keeps commands run concurrently from other threads
+    # from holding on to each other's pipes.)
+    with open(os.devnull) as devnull:
+        p = Popen(args, stdin=devnull, stdout=PIPE, stderr=PIPE, cwd=cwd,
+                  close_fds=True, preexec_fn=os.setsid)
 
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            # already exited
+            pass
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
     try:
-        # TODO: avoid shell with Popen
-        tex = Popen(cmd, shell=True, stdin=None, stdout=PIPE, stderr=PIPE)
-        tex.wait()
-        tex_out, tex_err = tex.communicate()
+        out, err = p.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+            # don't leave the timer thread running into interpreter
+            # shutdown
+            timer.join()
+
+    if killed:
+        raise TexTimeout('%s killed after %.1f seconds' % (args[0], timeout))
+    return out, err
+
+# version of the tex toolchain, determined on first use
+_tex_toolchain = None
+
+def tex_toolchain():
+    """
+    Returns a string identifying the versions of tex and catdvi in
+    use. Failed conversions are recorded with this, and retried when
+    it changes.
+    """
+
+    global _tex_toolchain
+
+    if _tex_toolchain is None:
+        versions = []
+        for command in (TEX_COMMAND, CATDVI_COMMAND):
+            try:
+                out, err = run_command([command[0], '--version'],
+                                       timeout=TEX_TIMEOUT)
+                out = out.strip() or err.strip()
+                versions.append(out.split('\n')[0].strip())
+            except (OSError, TexTimeout):
+                versions.append('')
+        _tex_toolchain = ' / '.join(v or 'unknown' for v in versions)
+
+    return _tex_toolchain
+
+def known_failures(cache, keys):
+    """
+    Returns a dict mapping those of the given keys that the cache
+    records as failing to convert with the current tex toolchain to
+    the reason for the failure.
+    """
+
+    failed = cache.get_failures(keys) if keys else {}
+    if not failed:
+        return {}
+    toolchain = tex_toolchain()
+    return dict((k, reason) for k, (reason, version, count) in failed.items()
+                if version == toolchain and reason not in TRANSIENT_FAILURES)
+
+# precompiled formats by preamble, None for failures to build
+_tex_formats = {}
+_tex_formats_lock = threading.Lock()
+
+def tex_format(preamble):
+    """
+    Returns the path of a precompiled tex format holding the given
+    preamble, building it if necessary, or None if the preamble is
+    not a standard one (consisting of declarations matching texdecl_re
+    only) or the format cannot be built. Formats are kept in
+    TEX_FORMAT_DIR for reuse by later runs.
+    """
+
+    if not TEX_FORMATS or texdecl_re.sub('', preamble).strip() != '':
+        return None
+
+    with _tex_formats_lock:
+        if preamble not in _tex_formats:
+            from hashlib import sha1
+            # formats only work with the tex that dumped them
+            key = sha1((tex_toolchain() + '\n' +
+                        preamble).encode(OUTPUT_ENCODING)).hexdigest()
+            fmt = os.path.join(os.path.abspath(TEX_FORMAT_DIR), key + '.fmt')
+            if not os.path.exists(fmt):
+                fmt = build_tex_format(preamble, fmt)
+            _tex_formats[preamble] = fmt
+        return _tex_formats[preamble]
+
+def build_tex_format(preamble, fmt):
+    """
+    Dumps a tex format holding the given preamble into the file fmt.
+    Returns fmt, or None if the format cannot be built. Failures are
+    marked with a file next to fmt so that they are not retried.
+    """
+
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    if os.path.exists(fmt + '.failed'):
+        return None
+
+    try:
+        if not os.path.isdir(os.path.dirname(fmt)):
+            os.makedirs(os.path.dirname(fmt))
+        # build next to the target, so that the format can be moved
+        # in place atomically also if other processes build it too
+        tmpdir = mkdtemp(prefix='nxml2txt-', dir=os.path.dirname(fmt))
+    except (IOError, OSError), e:
+        print >> sys.stderr, "rewritetex: failed to create format directory:", e
+        return None
+
+    try:
+        ini_fn = os.path.join(tmpdir, 'preamble.tex')
+        with open(ini_fn, 'w') as ini_file:
+            ini_file.write(preamble.encode(OUTPUT_ENCODING) + '\n\\dump\n')
+
+        cmd = TEX_INI_COMMAND + ['-jobname=preamble',
+                                 '-output-directory='+tmpdir, '&latex', ini_fn]
+        try:
+            run_command(cmd, tmpdir, TEX_FORMAT_TIMEOUT)
+        except TexTimeout, e:
+            print >> sys.stderr, "rewritetex: failed to build tex format:", e
+
+        built = os.path.join(tmpdir, 'preamble.fmt')
+        if not os.path.exists(built):
+            print >> sys.stderr, 'rewritetex: failed to build tex format for:\n"""\n%s\n"""' % preamble.encode(OUTPUT_ENCODING)
+            open(fmt + '.failed', 'w').close()
+            return None
+
+        os.rename(built, fmt)
+        return fmt
+    except (IOError, OSError), e:
+        print >> sys.stderr, "rewritetex: failed to build tex format:", e
+        return None
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+def tex_compile(fn, output=None, fmt=None, timeout=None):
+    """
+    Invokes tex to compile the file with the given name, placing the
+    output in the directory containing the file, using the given
+    precompiled format if any.
+    Returns the name of the output file (.dvi), the empty string if
+    the name could not be determined, or None if compilation fails.
+    If output is given, the tex output is appended to it. Raises
+    TexTimeout if tex runs longer than timeout seconds.
+    """
+
+    outputdir = os.path.dirname(os.path.abspath(fn))
+    cmd = TEX_COMMAND + ['-output-directory='+outputdir, fn]
+    if fmt is not None:
+        cmd = TEX_COMMAND + ['-fmt='+fmt, '-output-directory='+outputdir, fn]
+
+    try:
+        tex_out, tex_err = run_command(cmd, outputdir, timeout)
+
+        if output is not None:
+            output.append(tex_out)
 
         # check tex output to determine output file name or to see
         # if an error message indicating nothing was output is
@@ -250,43 +1011,33 @@ def tex_compile(fn):
             return None
 
         return dvifn
-    except IOError:
+    except (IOError, OSError):
         #print >> sys.stderr, "rewritetex: error compiling tex document!"
         return None
 
-def run_catdvi(fn):
+def run_catdvi(fn, timeout=None):
     """
     Invokes catdvi to get the text content of the given .dvi file.
-    Returns catdvi output or None if the invocation fails.
+    Returns catdvi output or None if the invocation fails. Raises
+    TexTimeout if catdvi runs longer than timeout seconds.
     """
 
-    from subprocess import PIPE, Popen
-
-    cmd = CATDVI_COMMAND+' '+fn
+    cmd = CATDVI_COMMAND + [fn]
 
     try:
-        # TODO: avoid shell with Popen
-        catdvi = Popen(cmd, shell=True, stdin=None, stdout=PIPE, stderr=PIPE)
-        catdvi.wait()
-        catdvi_out, catdvi_err = catdvi.communicate()
+        catdvi_out, catdvi_err = run_command(cmd, timeout=timeout)
         return catdvi_out
-    except IOError, e:
+    except (IOError, OSError), e:
         print >> sys.stderr, "rewritetex: failed to invoke catdvi:", e
         return None
 
-def tex2str(tex):
+def prepare_tex(tex):
     """
-    Given a tex document as a string, returns a text string
-    approximating the tex content. Performs conversion using the
-    external tools tex and catdvi.
+    Performs some minor tweaks to the given tex document to get
+    around compilation problems that frequently arise with PMC NXML
+    embedded tex.
     """
 
-    from tempfile import NamedTemporaryFile
-
-    # perform some minor tweaks to the given tex document to get
-    # around compilation problems that frequently arise with PMC
-    # NXML embedded tex:
-
     # remove "\usepackage{pmc}". It's not clear what the contents
     # of this package are (I have not been able to find it), but
     # compilation more often succeeds without it than with it.
@@ -298,49 +1049,303 @@ def tex2str(tex):
     tex = re.sub(r'(\\documentclass(?:\[[^\[\]]*\])?\{)minimal(\})',
                  r'\1slides\2', tex)
 
-    # now ready to try conversion.
+    return tex
 
-    # create a temporary file for the tex content
-    try:
-        with NamedTemporaryFile('w', suffix='.tex') as tex_tmp:
-            tex_tmp.write(tex.encode(OUTPUT_ENCODING))
-            tex_tmp.flush()
+def split_tex(tex):
+    """
+    Given a tex document, returns a (preamble, body) pair, or None if
+    the document has no recognizable body.
+    """
 
-            tex_out_fn = tex_compile(tex_tmp.name)
+    m = texbody_re.search(tex)
+    if m is None:
+        return None
+    return tex[:m.start()], m.group(1)
 
-            if tex_out_fn is None:
-                # failed to compile
-                print >> sys.stderr, 'rewritetex: failed to compile tex document:\n"""\n%s\n"""' % tex.encode(OUTPUT_ENCODING)
-                return None
+def tex2str(tex):
+    """
+    Given a tex document as a string, returns a text string
+    approximating the tex content. Performs conversion using the
+    external tools tex and catdvi.
+    """
 
-            # if no output file name could be found in tex output
-            # in the expected format, back off to an expected default
-            if tex_out_fn == "":
-                expected_out_fn = tex_tmp.name.replace(".tex", ".dvi")
-                tex_out_fn = os.path.join(TEX_OUTPUTDIR,
-                                            os.path.basename(expected_out_fn))
+    return compile_tex2str(prepare_tex(tex))
 
-            dvistr = run_catdvi(tex_out_fn)
+def compile_tex2str(tex, output=None, verbose=True, failure=None,
+                    timeout=None, deadline=None):
+    """
+    Given a tex document prepared with prepare_tex(), returns a text
+    string approximating the tex content, or None if conversion
+    fails. If output is given, the tex output is appended to it, and
+    if failure is given, the reason for a failure is appended to it.
+    tex and catdvi are each given timeout seconds (default
+    TEX_TIMEOUT), but no time past the given deadline (time.time()).
+    """
 
-            try:
-                dvistr = dvistr.decode(INPUT_ENCODING)
-            except UnicodeDecodeError:
-                print >> sys.stderr, 'rewritetex: error decoding catdvi output as %s (adjust INPUT_ENCODING?)' % INPUT_ENCODING
-
-            if dvistr is None or dvistr == "":
-                print >> sys.stderr, 'rewritetex: likely error invoking catdvi (empty output)'
-                return None
-
-            # perform minor whitespace cleanup
-            dvistr = re.sub(r'\s+', ' ', dvistr)
-            dvistr = re.sub(r'^\s+', '', dvistr)
-            dvistr = re.sub(r'\s+$', '', dvistr)
-
-            return dvistr
-    except IOError:
-        print >> sys.stderr, "rewritetex: failed to create temporary file"
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    if timeout is None:
+        timeout = TEX_TIMEOUT
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
+        if timeout <= 0:
+            if failure is not None:
+                failure.append(FAILURE_BUDGET)
+            return None
+
+    # each conversion works in a private scratch directory, which
+    # holds the tex document and everything tex writes, so that
+    # conversions can run concurrently.
+    try:
+        tmpdir = mkdtemp(prefix='nxml2txt-', dir=TEX_TMPDIR)
+    except (IOError, OSError):
+        print >> sys.stderr, "rewritetex: failed to create temporary directory"
         raise
 
+    try:
+        # with a precompiled format holding the preamble, only the
+        # document proper is compiled. (The preamble is replaced by
+        # empty lines to keep line numbers in error messages.)
+        fmt, parts = None, split_tex(tex)
+        if parts is not None:
+            fmt = tex_format(parts[0])
+        if fmt is not None:
+            preamble, body = parts
+            tex = ('\n' * preamble.count('\n') + '\\begin{document}' + body +
+                   '\\end{document}\n')
+
+        tex_fn = os.path.join(tmpdir, 'formula.tex')
+        with open(tex_fn, 'w') as tex_file:
+            tex_file.write(tex.encode(OUTPUT_ENCODING))
+
+        tex_out_fn = tex_compile(tex_fn, output, fmt, timeout)
+
+        if tex_out_fn is None:
+            # failed to compile
+            if failure is not None:
+                failure.append(FAILURE_COMPILE)
+            if verbose:
+                print >> sys.stderr, 'rewritetex: failed to compile tex document:\n"""\n%s\n"""' % tex.encode(OUTPUT_ENCODING)
+            return None
+
+        # if no output file name could be found in tex output
+        # in the expected format, back off to an expected default
+        if tex_out_fn == "" or not os.path.exists(tex_out_fn):
+            tex_out_fn = os.path.join(tmpdir, 'formula.dvi')
+
+        dvistr = run_catdvi(tex_out_fn, timeout)
+
+        if dvistr is None or dvistr == "":
+            print >> sys.stderr, 'rewritetex: likely error invoking catdvi (empty output)'
+            if failure is not None:
+                failure.append(FAILURE_EMPTY)
+            return None
+
+        try:
+            dvistr = dvistr.decode(INPUT_ENCODING)
+        except UnicodeDecodeError:
+            print >> sys.stderr, 'rewritetex: error decoding catdvi output as %s (adjust INPUT_ENCODING?)' % INPUT_ENCODING
+
+        # perform minor whitespace cleanup
+        dvistr = re.sub(r'\s+', ' ', dvistr)
+        dvistr = re.sub(r'^\s+', '', dvistr)
+        dvistr = re.sub(r'\s+$', '', dvistr)
+
+        return dvistr
+    except TexTimeout, e:
+        if failure is not None:
+            if deadline is not None and time.time() >= deadline:
+                failure.append(FAILURE_BUDGET)
+            else:
+                failure.append(FAILURE_TIMEOUT)
+        if verbose:
+            print >> sys.stderr, 'rewritetex: tex conversion timed out: %s' % e
+        return None
+    finally:
+        rmtree(tmpdir, ignore_errors=True)
+
+def compile_tex2str_failure(tex, deadline=None):
+    """
+    Like compile_tex2str(), but returns a (text, failure reason)
+    pair, with None for the reason on success.
+    """
+
+    failure = []
+    s = compile_tex2str(tex, failure=failure, deadline=deadline)
+    return s, (failure[0] if failure else None)
+
+def tex_error_lines(tex_out):
+    """
+    Returns the set of input line numbers that the errors in the given
+    tex output refer to, or None if some error has no line number.
+    """
+
+    lines = set()
+    errors = [m.start() for m in texerror_re.finditer(tex_out)]
+    for i, start in enumerate(errors):
+        end = errors[i+1] if i+1 < len(errors) else len(tex_out)
+        m = texerrorline_re.search(tex_out, start, end)
+        if m is None:
+            return None
+        lines.add(int(m.group(1)))
+    return lines
+
+def batch_tex2str(preamble, bodies, deadline=None):
+    """
+    Given a tex preamble and the bodies of documents sharing it,
+    compiles the bodies as the pages of a single tex document and
+    returns a list of text strings approximating each, with None for
+    those that failed to convert. No time is taken past the given
+    deadline.
+    """
+
+    # start each formula on a new page numbered 1 with a marker to
+    # identify its output, and group it to isolate any settings
+    chunks, ranges = [preamble, '\\begin{document}\n'], []
+    line = 1 + preamble.count('\n') + 1
+    for i, body in enumerate(bodies):
+        chunk = ('\\clearpage\\setcounter{page}{1}\n' +
+                 TEX_BATCH_MARKER % i + '\\par\n' +
+                 '\\begingroup\n' + body + '\n\\endgroup\n')
+        lines = chunk.count('\n')
+        ranges.append((line, line + lines - 1))
+        chunks.append(chunk)
+        line += lines
+    chunks.append('\\end{document}\n')
+
+    failed = [None] * len(bodies)
+
+    output = []
+    timeout = TEX_TIMEOUT + TEX_BATCH_TIMEOUT * len(bodies)
+    dvistr = compile_tex2str(''.join(chunks), output, verbose=False,
+                             timeout=timeout, deadline=deadline)
+    if dvistr is None:
+        return failed
+
+    # formulas with errors are retried separately
+    error_lines = tex_error_lines(output[0]) if output else set()
+    if error_lines is None:
+        return failed
+
+    # split output at markers; any missing indicates an error that
+    # swallowed some of the document
+    parts = texmarker_re.split(dvistr)
+    indices = [int(i) for i in parts[1::2]]
+    if indices != range(len(bodies)):
+        return failed
+
+    results = []
+    for (first, last), text in zip(ranges, parts[2::2]):
+        text = text.strip()
+        if not text or any(first <= l <= last for l in error_lines):
+            results.append(None)
+        else:
+            results.append(text)
+    return results
+
+def map_jobs(function, items, jobs=TEX_JOBS):
+    """
+    Returns map(function, items), running up to the given number of
+    calls concurrently. (Threads suffice, as the work is done by
+    external processes.)
+    """
+
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return map(function, items)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def tex2str_batch(texs, batch_size=TEX_BATCH_SIZE, jobs=TEX_JOBS,
+                  failures=None, budget=None):
+    """
+    Given a list of tex documents, returns a list of text strings
+    approximating their content, with None for those that fail to
+    convert. Documents with identical preambles are compiled together
+    (up to batch_size at a time) to avoid running latex and catdvi
+    for each. Documents that fail in a batch are retried separately.
+    Up to the given number of conversions are run concurrently. If
+    failures is given, it is filled with a map from the index of each
+    failed document to the reason for the failure. If budget is given,
+    documents not converted within that many seconds fail with
+    FAILURE_BUDGET.
+    """
+
+    deadline = time.time() + budget if budget is not None else None
+    results = [None] * len(texs)
+    prepared = [prepare_tex(t) for t in texs]
+
+    groups, retry = {}, []
+    for i, tex in enumerate(prepared):
+        parts = split_tex(tex)
+        if parts is None:
+            retry.append(i)
+        else:
+            preamble, body = parts
+            if preamble not in groups:
+                groups[preamble] = []
+            groups[preamble].append((i, body))
+
+    batches = []
+    for preamble, documents in groups.items():
+        for start in range(0, len(documents), batch_size):
+            batch = documents[start:start+batch_size]
+            if len(batch) == 1:
+                retry.append(batch[0][0])
+            else:
+                batches.append((preamble, batch))
+
+    def convert_batch((preamble, batch)):
+        return batch_tex2str(preamble, [body for i, body in batch], deadline)
+
+    def convert_one(tex):
+        return compile_tex2str_failure(tex, deadline)
+
+    for (preamble, batch), converted in zip(batches,
+                                            map_jobs(convert_batch, batches,
+                                                     jobs)):
+        for (i, body), s in zip(batch, converted):
+            if s is None:
+                retry.append(i)
+            else:
+                results[i] = s
+
+    retry.sort()
+    converted = map_jobs(convert_one, [prepared[i] for i in retry], jobs)
+    for i, (s, reason) in zip(retry, converted):
+        results[i] = s
+        if s is None and failures is not None:
+            failures[i] = reason
+
+    return results
+
+def convert_texs(texs, options=None, failures=None):
+    """
+    Given a list of tex documents, returns a list of text strings
+    approximating their content, with None for failed conversions.
+    If failures is given, it is filled as by tex2str_batch().
+    """
+
+    batch_size = getattr(options, 'batch_size', None)
+    if batch_size is None:
+        batch_size = TEX_BATCH_SIZE
+    jobs = getattr(options, 'jobs', None)
+    if jobs is None:
+        jobs = TEX_JOBS
+    budget = getattr(options, 'budget', None)
+    if budget is None:
+        budget = TEX_BUDGET
+
+    # (with a batch size of 1, each document is compiled separately)
+    return tex2str_batch(texs, max(batch_size, 1), jobs, failures, budget)
+
 def rewrite_tex_element(e, s):
     """
     Given an XML tree element e and a string s, stores the original
@@ -371,59 +1376,180 @@ class Stats(object):
         self.cache_misses = 0
         self.conversions_ok = 0
         self.conversions_err = 0
+        # occurrences of formulas known to fail, not converted again
+        self.known_failures = 0
+        # occurrences of formulas converted in-process (see texmath)
+        self.inprocess = 0
+        # occurrences of formulas whose conversion timed out, and of
+        # those left unconverted when the time budget ran out
+        self.timeouts = 0
+        self.over_budget = 0
+        # lookups of the in-memory cache (see LRUCache)
+        self.memory_hits = 0
+        self.memory_misses = 0
+        self.memory_evictions = 0
 
     def zero(self):
         return (self.rewrites == 0 and
                 self.cache_hits == 0 and
                 self.cache_misses == 0 and
                 self.conversions_ok == 0 and
-                self.conversions_err == 0)
+                self.conversions_err == 0 and
+                self.known_failures == 0 and
+                self.inprocess == 0 and
+                self.timeouts == 0 and
+                self.over_budget == 0)
+
+    def coverage(self):
+        """
+        Returns the fraction of formulas missing from the cache that
+        were converted in-process.
+        """
+
+        total = self.inprocess + self.cache_misses + self.known_failures
+        return float(self.inprocess) / total if total else 0.0
+
+    def add_memory_counters(self, before, after):
+        """
+        Adds the change in LRUCache.counters() between the given
+        values.
+        """
+
+        hits, misses, evictions = [a - b for a, b in zip(after, before)]
+        self.memory_hits += hits
+        self.memory_misses += misses
+        self.memory_evictions += evictions
 
     def __str__(self):
-        return \
-            '%d rewrites (%d cache hits, %d misses; converted %d, failed %d)' %\
+        s = '%d rewrites (%d cache hits, %d misses; converted %d, failed %d)' %\
             (self.rewrites, self.cache_hits, self.cache_misses,
              self.conversions_ok, self.conversions_err)
-
-def process_tree(tree, cache=None, stats=None, options=None):
-    if cache is None:
+        if self.known_failures:
+            s += ' (skipped %d known failures)' % self.known_failures
+        if self.timeouts or self.over_budget:
+            s += ' (%d timed out, %d over budget)' % \
+                (self.timeouts, self.over_budget)
+        if self.inprocess:
+            s += ' (%d converted in-process, %.1f%% coverage)' % \
+                (self.inprocess, 100 * self.coverage())
+        if self.memory_hits or self.memory_misses:
+            s += ' (in memory: %d hits, %d misses, %d evictions)' % \
+                (self.memory_hits, self.memory_misses, self.memory_evictions)
+        return s
+
+def process_tree(tree, cache=None, stats=None, options=None, elements=None):
+    local_cache = cache is None
+    if local_cache:
         cache = get_cache()
     if stats is None:
         stats = Stats()
 
     root = tree.getroot()
 
+    # cache misses, converted together once all are known. Map
+    # from normalized tex to the tex and the elements containing it.
+    misses, order = {}, []
+
     # find "tex-math" elements in any namespace ("local-name")
-    # anywhere in the tree.
-    for e in root.xpath("//*[local-name()='tex-math']"):
+    # anywhere in the tree unless given.
+    if elements is None:
+        elements = root.xpath("//*[local-name()='tex-math']")
+
+    # normalize the tex documents for cache lookup, looking up all of
+    # the document at once
+    normalized = [normalize_tex(e.text) for e in elements]
+    # the in-memory cache counters are read once all lookups and the
+    # storing of new conversions (which may evict entries) are done
+    counters = getattr(cache, 'counters', None)
+    if counters is not None:
+        before = counters()
+    found = cache.get_many(normalized) if elements else {}
+
+    for e, tex_norm in zip(elements, normalized):
         tex = e.text
 
-        # normalize the tex document for cache lookup
-        tex_norm = normalize_tex(tex)
+        if tex_norm in misses:
+            misses[tex_norm][1].append(e)
+            continue
 
-        mapped = cache.get(tex_norm)
+        mapped = found.get(tex_norm)
 
         if mapped is not None:
             stats.cache_hits += 1
-        else:
-            stats.cache_misses += 1
-
-            # no existing mapping to string; try to convert
-            s = tex2str(tex)
-            
-            # only use results of successful conversions
-            if s is None or s == "":
-                mapped = None
-                stats.conversions_err += 1
-            else:
-                stats.conversions_ok += 1
-                mapped = s
-                cache.set(tex_norm, s)
-
-        if mapped is not None:
             # replace the <tex-math> element with the mapped text
             rewrite_tex_element(e, mapped)
             stats.rewrites += 1
+        else:
+            misses[tex_norm] = (tex, [e])
+            order.append(tex_norm)
+
+    # formulas in the subset of tex supported by texmath are converted
+    # in-process. (The results are not cached, being cheap to redo.)
+    if getattr(options, 'texmath', TEXMATH):
+        remaining = []
+        for tex_norm in order:
+            tex, elements = misses[tex_norm]
+            s = texmath.tex2str(prepare_tex(tex))
+            if s is None:
+                remaining.append(tex_norm)
+                continue
+            stats.inprocess += len(elements)
+            for e in elements:
+                rewrite_tex_element(e, s)
+                stats.rewrites += 1
+        order = remaining
+
+    # formulas that failed to convert with the current toolchain are
+    # not tried again
+    known = known_failures(cache, order)
+    if known:
+        toolchain = tex_toolchain()
+        for tex_norm, reason in known.items():
+            count = len(misses[tex_norm][1])
+            cache.add_failure(tex_norm, reason, toolchain, count)
+            stats.known_failures += count
+        order = [n for n in order if n not in known]
+
+    # no existing mapping to string; try to convert
+    failures = {}
+    converted = convert_texs([misses[n][0] for n in order], options,
+                             failures)
+
+    for i, (tex_norm, s) in enumerate(zip(order, converted)):
+        tex, elements = misses[tex_norm]
+
+        # only use results of successful conversions
+        if s is None or s == "":
+            reason = failures.get(i, FAILURE_EMPTY)
+            stats.cache_misses += len(elements)
+            if reason == FAILURE_BUDGET:
+                # not a failure of the formula; left for later runs
+                stats.over_budget += len(elements)
+                continue
+            if reason == FAILURE_TIMEOUT:
+                stats.timeouts += len(elements)
+            stats.conversions_err += len(elements)
+            if reason not in TRANSIENT_FAILURES:
+                cache.add_failure(tex_norm, reason, tex_toolchain(),
+                                  len(elements))
+            continue
+
+        stats.cache_misses += 1
+        stats.conversions_ok += 1
+        cache.set(tex_norm, s)
+
+        # further occurrences would have been found in the cache
+        stats.cache_hits += len(elements) - 1
+
+        for e in elements:
+            rewrite_tex_element(e, s)
+            stats.rewrites += 1
+
+    if counters is not None:
+        stats.add_memory_counters(before, counters())
+
+    if local_cache:
+        cache.flush()
 
     return tree
 
@@ -461,7 +1587,7 @@ def write_tree(tree, options=None):
 
 def process(fn, cache=None, stats=None, options=None):
     tree = read_tree(fn)
-    process_tree(tree)
+    process_tree(tree, cache, stats, options)
     write_tree(tree, options)
 
 def argparser():
@@ -471,14 +1597,34 @@ def argparser():
     ap.add_argument('-o', '--overwrite', default=False, action='store_true', help='allow output to overwrite input files')
     ap.add_argument('-s', '--stdout', default=False, action='store_true', help='output to stdout')
     ap.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output')
-    ap.add_argument('file', nargs='+', help='input PubMed Central NXML file')
+    ap.add_argument('-j', '--jobs', default=TEX_JOBS, type=int, metavar='N', help='run up to N tex conversions concurrently (default %d)' % TEX_JOBS)
+    ap.add_argument('-b', '--batch-size', default=TEX_BATCH_SIZE, type=int, metavar='N', help='compile up to N formulas in one tex document (default %d, 1 to disable)' % TEX_BATCH_SIZE)
+    ap.add_argument('-t', '--timeout', default=TEX_TIMEOUT, type=float, metavar='SEC', help='kill tex and catdvi after SEC seconds (default %g)' % TEX_TIMEOUT)
+    ap.add_argument('-B', '--budget', default=TEX_BUDGET, type=float, metavar='SEC', help='leave formulas unconverted after SEC seconds of tex conversion for a file (default %g)' % TEX_BUDGET)
+    ap.add_argument('-x', '--external', dest='texmath', default=TEXMATH, action='store_false', help='convert all formulas with tex and catdvi, also those supported in-process')
+    ap.add_argument('-f', '--failures', default=None, type=int, metavar='N', help='report the N most frequent failed conversions in the cache')
+    ap.add_argument('file', nargs='*', help='input PubMed Central NXML file')
     return ap
 
+def report_failures(cache, n):
+    for tex, reason, toolchain, count in cache.failures(n):
+        print '%d\t%s\t%s\t%s' % (count, reason, toolchain,
+                                   tex.encode(OUTPUT_ENCODING))
+
 def main(argv):
-    options = argparser().parse_args(argv[1:])
+    global TEX_TIMEOUT
+
+    ap = argparser()
+    options = ap.parse_args(argv[1:])
+    if not options.file and options.failures is None:
+        ap.error('no input files')
+    TEX_TIMEOUT = options.timeout
     stats = Stats()
     cache = get_cache()
 
+    if options.failures is not None:
+        report_failures(cache, options.failures)
+
     for fn in options.file:
         process(fn, cache, stats, options)
 
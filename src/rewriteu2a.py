@@ -14,6 +14,7 @@ import sys
 import os
 import re
 import codecs
+import marshal
 
 from lxml import etree as ET
 
@@ -24,6 +25,17 @@ from lxml import etree as ET
 MAPPING_FILE_NAME = os.path.join(os.path.dirname(__file__),
                                  '../data/entities.dat')
 
+# Suffix of the file holding the mapping compiled for fast loading,
+# kept next to the mapping file and rebuilt when that changes.
+COMPILED_MAPPING_SUFFIX = '.marshal'
+
+# Version of the compiled mapping format
+COMPILED_MAPPING_VERSION = 1
+
+# Number of code points held in the table of a Mapping (the Basic
+# Multilingual Plane); others are looked up in a dict.
+MAPPING_TABLE_SIZE = 0x10000
+
 # XML tag to use to mark text content rewritten by this script.
 REWRITTEN_TAG = 'n2t-u2a'
 
@@ -37,6 +49,69 @@ MISSING_MAPPING_FILE_NAME = 'missing-mappings.txt'
 INPUT_ENCODING="UTF-8"
 OUTPUT_ENCODING="UTF-8"
 
+# characters that may need to be mapped
+nonascii_re = re.compile(u'[^\x00-\x7f]')
+
+# Depth below the root of the subtrees checked as a whole for holding
+# ASCII only, to skip them without examining each text and tail (in
+# NXML, e.g. the paragraphs of subsections and the citations in
+# reference lists). Only subtrees at a single depth are checked, so
+# that no text is serialized for checking more than once.
+ASCII_SUBTREE_DEPTH = 4
+
+class Stats(object):
+    """
+    Counts of the texts and tails examined for characters to rewrite,
+    and of those skipped as ASCII only, either one at a time or with
+    their whole subtree.
+    """
+
+    def __init__(self):
+        # texts and tails examined one at a time, and their characters
+        self.strings = 0
+        self.chars = 0
+        # of these, those holding ASCII only
+        self.ascii_strings = 0
+        self.ascii_chars = 0
+        # elements whose subtrees held ASCII only, and the characters
+        # in these
+        self.ascii_subtrees = 0
+        self.subtree_chars = 0
+
+    def add_string(self, s, ascii):
+        self.strings += 1
+        self.chars += len(s)
+        if ascii:
+            self.ascii_strings += 1
+            self.ascii_chars += len(s)
+
+    def add_subtree(self, text):
+        self.ascii_subtrees += 1
+        self.subtree_chars += len(text)
+
+    def merge(self, other):
+        """
+        Adds the counts of the given Stats to these.
+        """
+
+        for attr in ('strings', 'chars', 'ascii_strings', 'ascii_chars',
+                     'ascii_subtrees', 'subtree_chars'):
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+
+    def skipped(self):
+        """
+        Returns the fraction of characters skipped as ASCII only.
+        """
+
+        total = self.chars + self.subtree_chars
+        skipped = self.ascii_chars + self.subtree_chars
+        return float(skipped) / total if total else 0.0
+
+    def __str__(self):
+        return '%d subtrees and %d of %d texts ASCII only, skipped (%.1f%% of %d characters)' % \
+            (self.ascii_subtrees, self.ascii_strings, self.strings,
+             100 * self.skipped(), self.chars + self.subtree_chars)
+
 def read_mapping(f, fn="mapping data"):
     """
     Reads in mapping from Unicode to ASCII from the given input stream
@@ -72,6 +147,119 @@ def read_mapping(f, fn="mapping data"):
 
     return mapping
 
+class Mapping(object):
+    """
+    Mapping from Unicode characters to ASCII replacements, with a
+    table indexed by code point for characters in the Basic
+    Multilingual Plane and a dict for others.
+    """
+
+    def __init__(self, mapping=None):
+        self.table = [None] * MAPPING_TABLE_SIZE
+        self.overflow = {}
+        if mapping is not None:
+            for c, r in mapping.iteritems():
+                self[c] = r
+
+    def get(self, c, default=None):
+        if len(c) == 1:
+            i = ord(c)
+            if i < MAPPING_TABLE_SIZE:
+                r = self.table[i]
+                return r if r is not None else default
+        return self.overflow.get(c, default)
+
+    def __getitem__(self, c):
+        r = self.get(c)
+        if r is None:
+            raise KeyError(c)
+        return r
+
+    def __setitem__(self, c, r):
+        if len(c) == 1 and ord(c) < MAPPING_TABLE_SIZE:
+            self.table[ord(c)] = r
+        else:
+            self.overflow[c] = r
+
+    def __contains__(self, c):
+        return self.get(c) is not None
+
+    def __len__(self):
+        return (MAPPING_TABLE_SIZE - self.table.count(None) +
+                len(self.overflow))
+
+    def iteritems(self):
+        for i, r in enumerate(self.table):
+            if r is not None:
+                yield unichr(i), r
+        for c, r in self.overflow.iteritems():
+            yield c, r
+
+def _mapping_stamp(mapfn):
+    # cheap check for changes to the mapping file
+    st = os.stat(mapfn)
+    return st.st_mtime, st.st_size
+
+def _mapping_digest(mapfn):
+    from hashlib import sha1
+    with open(mapfn, 'rb') as f:
+        return sha1(f.read()).hexdigest()
+
+def compile_mapping(mapping, mapfn, compiledfn):
+    """
+    Writes the given mapping read from the file mapfn into compiledfn
+    for load_compiled_mapping().
+    """
+
+    from tempfile import mkstemp
+
+    codes, values = [], []
+    for c, r in mapping.iteritems():
+        codes.append(wide_ord(c))
+        values.append(r)
+    mtime, size = _mapping_stamp(mapfn)
+    data = (COMPILED_MAPPING_VERSION, mtime, size, _mapping_digest(mapfn),
+            codes, values)
+
+    # write next to the target and move in place, so that concurrent
+    # processes never read a partial file
+    fd, tmpfn = mkstemp(prefix='.', dir=os.path.dirname(compiledfn) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(data, f)
+        os.chmod(tmpfn, 0644)
+        os.rename(tmpfn, compiledfn)
+    except:
+        os.remove(tmpfn)
+        raise
+
+def load_compiled_mapping(mapfn, compiledfn):
+    """
+    Returns the Mapping compiled from the file mapfn into compiledfn,
+    or None if there is none or mapfn has changed since.
+    """
+
+    try:
+        with open(compiledfn, 'rb') as f:
+            data = marshal.load(f)
+        version, mtime, size, digest, codes, values = data
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != COMPILED_MAPPING_VERSION:
+        return None
+    if (mtime, size) != _mapping_stamp(mapfn) and \
+            digest != _mapping_digest(mapfn):
+        return None
+
+    mapping = Mapping()
+    table = mapping.table
+    for i, r in zip(codes, values):
+        if i < MAPPING_TABLE_SIZE:
+            table[i] = r
+        else:
+            mapping.overflow[wide_unichr(i)] = r
+    return mapping
+
 def wide_ord(char):
     try:
         return ord(char)
@@ -88,8 +276,9 @@ def wide_unichr(i):
         return (r'\U' + hex(i)[2:].zfill(8)).decode('unicode-escape')
 
 def mapchar(c, mapping, missing_mappings, options=None):
-    if c in mapping:
-        return mapping[c]
+    r = mapping.get(c)
+    if r is not None:
+        return r
     else:
         # make a note of anything unmapped
         missing_mappings.add("%.4X" % wide_ord(c))
@@ -103,97 +292,141 @@ def mapchar(c, mapping, missing_mappings, options=None):
         else:
             return "<%.4X>" % wide_ord(c)
 
-def replace_mapped_text(e, mapping, missing, options=None):
-    # TODO: inefficient, improve
-    for i, c in enumerate(e.text):
-        if wide_ord(c) >= 128:
-            s = mapchar(c, mapping, missing, options)
+def is_ascii(s):
+    """
+    Returns whether the given string holds ASCII characters only.
+    """
+
+    # lxml gives text holding ASCII only as str
+    return isinstance(s, str) or nonascii_re.search(s) is None
+
+def _nonascii_start(s, stats):
+    # offset of the first non-ASCII character of s, or None if none
+    m = None if isinstance(s, str) else nonascii_re.search(s)
+    if stats is not None:
+        stats.add_string(s, m is None)
+    return m.start() if m is not None else None
+
+def ascii_subtree(e, stats=None):
+    """
+    Returns whether the text of the given element and its descendants
+    holds ASCII characters only, adding it to stats if so.
+    """
+
+    # the text without the content of comments and processing
+    # instructions
+    text = ET.tostring(e, method='text', encoding=unicode, with_tail=False)
+    ascii = is_ascii(text)
+    if ascii and stats is not None:
+        stats.add_subtree(text)
+    return ascii
+
+def mapped_segments(s, mapping, missing, options=None, start=0):
+    """
+    Returns (offset, character, replacement) for each character of
+    the given string from the given offset on that is changed by the
+    mapping, finding these in a single pass over the string.
+    """
 
-            # if the character is unchanged, just skip
-            if s == c:
-                continue
+    segments = []
+    for m in nonascii_re.finditer(s, start):
+        c = m.group()
+        r = mapchar(c, mapping, missing, options)
 
-            # create new element for the replacement
-            r = ET.Element(REWRITTEN_TAG)
-            r.attrib[ORIG_TEXT_ATTRIBUTE] = c
-            r.text = s
+        # if the character is unchanged, just skip
+        if r != c:
+            segments.append((m.start(), c, r))
+    return segments
 
-            # ... make it the first child of the current element
+def rewritten_elements(s, segments):
+    """
+    Returns an element for each of the given segments of the given
+    string, with the text following the segment as its tail.
+    """
+
+    elements = []
+    for i, (offset, c, r) in enumerate(segments):
+        if i+1 < len(segments):
+            end = segments[i+1][0]
+        else:
+            end = len(s)
+
+        e = ET.Element(REWRITTEN_TAG)
+        e.attrib[ORIG_TEXT_ATTRIBUTE] = c
+        e.text = r
+        e.tail = s[offset+1:end]
+        elements.append(e)
+    return elements
+
+def replace_mapped_text(e, mapping, missing, options=None, stats=None):
+    start = _nonascii_start(e.text, stats)
+    if start is None:
+        return
+
+    segments = mapped_segments(e.text, mapping, missing, options, start)
+    if not segments:
+        return
+
+    # split the text between the element and replacements that
+    # become its first children
+    text = e.text
+    previous = None
+    for r in rewritten_elements(text, segments):
+        if previous is None:
             e.insert(0, r)
+        else:
+            previous.addnext(r)
+        previous = r
+    e.text = text[:segments[0][0]]
+
+def replace_mapped_tail(e, mapping, missing, parent, options=None,
+                        stats=None):
+    start = _nonascii_start(e.tail, stats)
+    if start is None:
+        return
+
+    segments = mapped_segments(e.tail, mapping, missing, options, start)
+    if not segments:
+        return
+
+    # split the tail between the element and replacements that
+    # follow it in the parent
+    tail = e.tail
+    e.tail = tail[:segments[0][0]]
+    for r in rewritten_elements(tail, segments):
+        e.addnext(r)
+        e = r
+
+def replace_mapped(e, mapping, missing, parent=None, options=None,
+                   stats=None, depth=0):
+    if not isinstance(e.tag, basestring):
+        # the content of comments, processing instructions and
+        # entities is not text
+        pass
+    elif depth == ASCII_SUBTREE_DEPTH and len(e) and ascii_subtree(e, stats):
+        # skip subtrees holding ASCII only with a single check
+        pass
+    else:
+        # process text content
+        if e.text is not None and e.text != "":
+            replace_mapped_text(e, mapping, missing, options, stats)
 
-            # ... and split the text between the two
-            r.tail = e.text[i+1:]
-            e.text = e.text[:i]
-
-            # terminate search; the rest of the text is now
-            # in a different element
-            break
-
-def parent_index(e, parent):
-    for i, c in enumerate(parent):
-        if c == e:
-            return i
-    return None
-
-def replace_mapped_tail(e, mapping, missing, parent, options=None):
-    while True:
-        replaced = False
-        # TODO: inefficient, improve
-        for i, c in enumerate(e.tail):
-            # skip ASCII
-            if wide_ord(c) < 128:
-                continue
-
-            s = mapchar(c, mapping, missing, options)
-
-            # if the character is unchanged, just skip
-            if s == c:
-                continue
-
-            # create new element for the replacement
-            r = ET.Element(REWRITTEN_TAG)
-            r.attrib[ORIG_TEXT_ATTRIBUTE] = c
-            r.text = s
-
-            # ... make it the next child of the parent after the
-            # current
-            pidx = parent_index(e, parent)
-            parent.insert(pidx+1, r)
-
-            # ... and split the text between the two
-            r.tail = e.tail[i+1:]
-            e.tail = e.tail[:i]
-
-            # process the rest in the new element, avoiding tail
-            # recursion
-            replaced = True
-            e = r
-            break
-
-        if not replaced:
-            break
-
-def replace_mapped(e, mapping, missing, parent=None, options=None):
-    # process text content
-    if e.text is not None and e.text != "":
-        replace_mapped_text(e, mapping, missing, options)
-
-    # process children recursively
-    for c in e:
-        replace_mapped(c, mapping, missing, e, options)
+        # process children recursively
+        for c in e:
+            replace_mapped(c, mapping, missing, e, options, stats, depth+1)
 
     # process tail unless at root
     if parent is not None and e.tail is not None and e.tail != "":
-        replace_mapped_tail(e, mapping, missing, parent, options)
+        replace_mapped_tail(e, mapping, missing, parent, options, stats)
 
 def read_tree(filename):
     try:
-        return ET.parse(fn)
+        return ET.parse(filename)
     except ET.XMLSyntaxError:
-        print >> sys.stderr, "Error parsing %s" % fn
+        print >> sys.stderr, "Error parsing %s" % filename
         raise
 
-def write_tree(tree, options=None):
+def write_tree(tree, fn, options=None):
     if options is not None and options.stdout:
         tree.write(sys.stdout, encoding=OUTPUT_ENCODING)
         return True
@@ -218,20 +451,20 @@ def write_tree(tree, options=None):
                 
     return True
 
-def process_tree(tree, mapping=None, missing=None, options=None):
+def process_tree(tree, mapping=None, missing=None, options=None, stats=None):
     if mapping is None:
         mapping = load_mapping()
     if missing is None:
         missing = set()
 
     root = tree.getroot()
-    replace_mapped(root, mapping, missing, options=options)
+    replace_mapped(root, mapping, missing, options=options, stats=stats)
     return tree
 
-def process(fn, mapping, missing, options):
+def process(fn, mapping, missing, options, stats=None):
     tree = read_tree(fn)
-    process_tree(tree)
-    write_tree(tree, options)
+    process_tree(tree, mapping, missing, options, stats)
+    write_tree(tree, fn, options)
 
 def argparser():
     import argparse
@@ -246,22 +479,39 @@ def argparser():
                     help='write hex sequence for missing mappings')
     ap.add_argument('-k', '--keep-missing', default=False, action='store_true',
                     help='keep unicode for missing mappings')
+    ap.add_argument('-v', '--verbose', default=False, action='store_true',
+                    help='report text skipped as ASCII only')
     ap.add_argument('file', nargs='+', help='input PubMed Central NXML file')
     return ap
 
 def load_mapping(mapfn=MAPPING_FILE_NAME):
+    """
+    Returns the Mapping in the given file, loading it from its compiled
+    form if up to date and compiling it otherwise.
+    """
+
     if not os.path.exists(mapfn):
         # fall back to trying in script dir
         mapfn = os.path.join(os.path.dirname(__file__),
                              os.path.basename(MAPPING_FILE_NAME))
+    compiledfn = mapfn + COMPILED_MAPPING_SUFFIX
     try:
+        mapping = load_compiled_mapping(mapfn, compiledfn)
+        if mapping is not None:
+            return mapping
         with codecs.open(mapfn, encoding="utf-8") as f:
-            return read_mapping(f, mapfn)
-    except IOError, e:
+            mapping = read_mapping(f, mapfn)
+    except (IOError, OSError), e:
         print >> sys.stderr, "Error reading mapping from %s: %s" % (MAPPING_FILE_NAME, e)
         raise
 
-def write_missing(missing_mappings, filename=MISSING_MAPPING_FILE_NAME):
+    try:
+        compile_mapping(mapping, mapfn, compiledfn)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Warning: failed to write compiled mapping to %s: %s" % (compiledfn, e)
+    return Mapping(mapping)
+
+def write_missing(missing_mappings, fn, filename=MISSING_MAPPING_FILE_NAME):
     # if there were any missing mappings and an output file name is
     # defined for these, try to append them in that file.
     if len(missing_mappings) > 0 and filename is not None:
@@ -276,12 +526,15 @@ def main(argv):
     options = argparser().parse_args(argv[1:])
 
     mapping = load_mapping()
-    missing = set()
+    stats = Stats()
 
     for fn in options.file:
-        process(fn, mapping, missing, options)
+        missing = set()
+        process(fn, mapping, missing, options, stats)
+        write_missing(missing, fn)
 
-    write_missing(missing)
+    if options.verbose:
+        print >> sys.stderr, 'rewriteu2a: %s' % str(stats)
 
     return 0
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Service mode for nxml2txt: a long-running local HTTP server that
+# converts NXML documents posted to it, keeping the Unicode mapping,
+# TeX cache and parser warm in a bounded pool of worker processes.
+
+# This module is not meant to be run directly; it is invoked by the
+# nxml2txt driver, e.g.
+#
+#    ./nxml2txt --serve -p 8080 -j 4
+#    curl --data-binary @FILE.nxml http://localhost:8080/convert
+
+from __future__ import with_statement
+
+import sys
+import os
+import json
+import signal
+import threading
+
+from multiprocessing import Pool, cpu_count
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from io import BytesIO
+
+from lxml import etree as ET
+
+import batch
+
+# path accepting documents for conversion
+CONVERT_PATH = '/convert'
+
+# path reporting server status
+STATUS_PATH = '/status'
+
+# seconds a client is asked to wait when the server is saturated
+RETRY_AFTER = 1
+
+USAGE='%(prog)s --serve [OPTIONS]'
+
+def argparser():
+    import argparse
+    ap=argparse.ArgumentParser(description='Serve NXML to text and standoff conversion over HTTP.', usage=USAGE)
+    ap.add_argument('--serve', default=False, action='store_true', help='run as a service')
+    ap.add_argument('-H', '--host', default='localhost', help='host to listen on (default: localhost)')
+    ap.add_argument('-p', '--port', default=8080, type=int, help='port to listen on (default: 8080)')
+    ap.add_argument('-u', '--socket', default=None, metavar='PATH', help='listen on Unix socket PATH instead of TCP')
+    ap.add_argument('-j', '--jobs', default=None, type=int, metavar='N', help='number of worker processes (default: number of CPUs)')
+    ap.add_argument('-q', '--queue', default=None, type=int, metavar='N', help='number of requests to queue when all workers are busy (default: 2 x workers)')
+    ap.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output')
+    return ap
+
+def init_worker(convert, options=None):
+    # leave interrupts to the server process, which shuts down the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batch.init_worker(convert, options)
+
+def convert_request(data):
+    """
+    Converts a single posted document in a worker process. Returns a
+    tuple (HTTP status code, response content), the latter holding
+    the text and the standoffs in the .so file format on success.
+    """
+
+    # errors are returned rather than raised, as not all exceptions
+    # (e.g. lxml parse errors) survive the trip back from the worker.
+    worker = batch._worker
+    try:
+        text, standoffs = worker['convert'](BytesIO(data),
+                                            cache=worker['cache'],
+                                            mapping=worker['mapping'])
+    except ET.XMLSyntaxError, e:
+        return 400, { 'error': str(e) }
+    except Exception, e:
+        return 500, { 'error': '%s: %s' % (type(e).__name__, str(e)) }
+    finally:
+        # the pool is terminated on shutdown, so don't leave new TeX
+        # cache entries buffered between requests
+        worker['cache'].flush()
+    standoffs = batch.format_standoffs(standoffs).decode('utf-8')
+    return 200, { 'text': text, 'standoffs': standoffs }
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.converted = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def add(self, attr):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def json(self):
+        return { 'converted': self.converted, 'failed': self.failed,
+                 'rejected': self.rejected }
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    def respond(self, code, content, headers=()):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != STATUS_PATH:
+            return self.respond(404, { 'error': 'not found' })
+        self.respond(200, self.server.stats.json())
+
+    def do_POST(self):
+        if self.path != CONVERT_PATH:
+            return self.respond(404, { 'error': 'not found' })
+
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+        except (TypeError, ValueError):
+            return self.respond(411, { 'error': 'length required' })
+        data = self.rfile.read(length)
+
+        # apply backpressure: refuse work rather than queue without bound
+        stats = self.server.stats
+        if not self.server.slots.acquire(False):
+            stats.add('rejected')
+            return self.respond(503, { 'error': 'server busy' },
+                                [('Retry-After', str(RETRY_AFTER))])
+        try:
+            code, content = self.server.pool.apply(convert_request, (data,))
+        finally:
+            self.server.slots.release()
+
+        stats.add('converted' if code == 200 else 'failed')
+        self.respond(code, content)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(convert, options):
+    """
+    Creates the server and its pool of warm worker processes.
+    """
+
+    processes = options.jobs if options.jobs is not None else cpu_count()
+    queue = options.queue if options.queue is not None else 2 * processes
+
+    if options.socket is not None:
+        if os.path.exists(options.socket):
+            os.remove(options.socket)
+        server = ThreadingUnixServer(options.socket, ConversionHandler)
+    else:
+        server = ThreadingHTTPServer((options.host, options.port),
+                                     ConversionHandler)
+
+    server.pool = Pool(processes, init_worker, (convert, options))
+    server.slots = threading.BoundedSemaphore(processes + queue)
+    server.stats = Stats()
+    server.verbose = options.verbose
+    return server
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+def main(argv, convert):
+    options = argparser().parse_args(argv[1:])
+
+    server = make_server(convert, options)
+
+    # shut down cleanly also when stopped by a service manager
+    signal.signal(signal.SIGTERM, terminate)
+
+    if options.verbose:
+        where = options.socket or '%s:%d' % (options.host, options.port)
+        print >> sys.stderr, 'nxml2txt: serving on %s' % where
+
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        server.pool.terminate()
+        if options.socket is not None and os.path.exists(options.socket):
+            os.remove(options.socket)
+
+    return 0
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
 import sys
-import re
 import argparse
 
-import lxml
+from lxml import etree as ET
+
+import tags
 
 # string to use to indicate elided text in output
 ELIDED_TEXT_STRING = "[[[...]]]"
@@ -48,11 +49,7 @@ class Standoff:
 
     def tag(self):
         # remove namespace spec from output, if any
-        if self.element.tag[0] == "{":
-            tag = re.sub(r'\{.*?\}', '', self.element.tag)
-        else:
-            tag = self.element.tag
-        return tag
+        return tags.local_name(self.element.tag)
 
     def set_prefix(self, prefix):
         self.prefix = prefix
@@ -65,12 +62,8 @@ class Standoff:
     def __str__(self):
         # remove namespace specs from attribute names, if any
         attrib = {}
-        for a in self.element.attrib:
-            if a[0] == "{":
-                an = re.sub(r'\{.*?\}', '', a)
-            else:
-                an = a
-            attrib[an] = self.element.attrib[a]
+        for a, v in self.element.attrib.items():
+            attrib[tags.local_name(a)] = v
 
         return "%s%d\t%s %d %d\t%s\t%s" % (self.prefix, self.sid, self.tag(), self.start, self.end, c_escape(self.text.encode("utf-8")), " ".join(['%s="%s"' % (k.encode("utf-8"),c_escape(v).encode("utf-8")) for k,v in attrib.items()]))
 
@@ -126,14 +119,27 @@ def read_tree(filename):
     try:
         return ET.parse(filename)
     except Exception:
-        print >> sys.stderr, "%s: Error parsing %s" % (argv[0], in_fn)
+        print >> sys.stderr, "%s: Error parsing %s" % (sys.argv[0], filename)
         raise
 
 def convert_tree(tree, options=None):
+    global next_free_so_id
+
     root = tree.getroot()
 
+    # number standoffs from 1 in each document, also when converting
+    # several documents in one process
+    next_free_so_id = 1
+
     text, standoffs = text_and_standoffs(root)
 
+    return text, finish_standoffs(standoffs, options)
+
+def finish_standoffs(standoffs, options=None):
+    """
+    Filters, prefixes and compresses standoffs for output.
+    """
+
     # filter standoffs by tag
     if options is None or options.filter is None:
         filtered = set()
@@ -150,7 +156,7 @@ def convert_tree(tree, options=None):
     for so in standoffs:
         so.compress_text(MAXIMUM_TEXT_DISPLAY_LENGTH)
 
-    return text, standoffs
+    return standoffs
 
 def write_text(text, filename):
     # TODO: be portable
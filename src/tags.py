@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Resolution of the raw tags and attribute names of lxml elements.
+
+# This module is not meant to be run directly; the pipeline stages use
+# it to look up elements by tag without namespaces. lxml gives names
+# in Clark notation ("{namespace}local"), and stripping the namespace
+# on each lookup adds up over the millions of lookups per corpus while
+# only a few hundred distinct names occur. Local names and values
+# derived from them are therefore resolved once per distinct name.
+
+import re
+
+# maximum number of distinct names to remember; the tables are
+# cleared when this is exceeded (e.g. in a long-running server)
+MAX_NAMES = 10000
+
+namespace_re = re.compile(r'\{.*?\}')
+
+_local_names = {}
+
+def local_name(name):
+    """
+    Returns the given tag or attribute name without namespaces, or
+    None for the "tags" of comments, processing instructions and
+    entities.
+    """
+
+    try:
+        return _local_names[name]
+    except KeyError:
+        pass
+
+    if not isinstance(name, basestring):
+        local = None
+    elif name[0] == "{":
+        local = namespace_re.sub('', name)
+    else:
+        local = name
+
+    if len(_local_names) >= MAX_NAMES:
+        _local_names.clear()
+    _local_names[name] = local
+    return local
+
+class TagTable(object):
+    """
+    Maps raw tags to the values of the given function for their local
+    names (None for special elements), calling the function once for
+    each distinct tag.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.table = {}
+
+    def __getitem__(self, tag):
+        try:
+            return self.table[tag]
+        except KeyError:
+            pass
+
+        value = self.function(local_name(tag))
+        if len(self.table) >= MAX_NAMES:
+            self.table.clear()
+        self.table[tag] = value
+        return value
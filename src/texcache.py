@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Maintenance of the cache of tex document -> text mappings used by
+# rewritetex.
+
+# Merges caches built on different machines (SQLite databases, pickles
+# or snapshots) into the SQLite cache (data/tex2txt.db), renormalizes
+# its keys after changes to normalize_tex(), compacts it, prints size
+# and hit frequency statistics, and exports it into a read-only
+# snapshot that conversion processes map into memory instead of
+# loading, e.g.
+#
+#    python texcache.py -m node1/tex2txt.db node2/tex2txt.db -c
+#    python texcache.py -s -n 20
+#    python texcache.py -e ../data/tex2txt.snap
+
+from __future__ import with_statement
+
+import sys
+import os
+
+import rewritetex
+
+# number of entries to look up at a time when merging
+MERGE_CHUNK_SIZE = 500
+
+# initial bytes of SQLite database files
+SQLITE_MAGIC = 'SQLite format 3\0'
+
+def open_cache(filename):
+    """
+    Loads the cache in the given file, which can be a SQLite database
+    (opened read-only), a pickle or a snapshot.
+    """
+
+    with open(filename, 'rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+    if magic.startswith(rewritetex.SNAPSHOT_MAGIC):
+        return rewritetex.SnapshotCache.load(filename)
+    elif magic == SQLITE_MAGIC:
+        return rewritetex.SqliteCache.load(filename, readonly=True)
+    else:
+        return rewritetex.PickleCache.load(filename)
+
+def db_size(filename):
+    """
+    Returns the size in bytes of the given SQLite database, including
+    its write-ahead log.
+    """
+
+    return sum(os.path.getsize(fn) for fn in (filename, filename+'-wal')
+               if os.path.exists(fn))
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _show(s, width=60):
+    s = repr(s)
+    if len(s) > width:
+        s = s[:width-3] + '...'
+    return s
+
+def report_conflict(key, kept, other):
+    print >> sys.stderr, 'texcache: conflict for %s: kept %s, discarded %s' % \
+        (_show(key), _show(kept, 30), _show(other, 30))
+
+def export_snapshot(cache, filename):
+    """
+    Writes a snapshot of the given cache into the given file. Returns
+    the number of entries written.
+    """
+
+    return rewritetex.SnapshotCache.write(cache.items(), filename)
+
+def merge(cache, filename, conflict=None):
+    """
+    Adds the entries of the cache in the given file to the given
+    cache, keeping the values of entries already in the cache, and
+    adds up hit counts. For each entry whose values differ, calls
+    conflict(key, kept, discarded) if given. Returns the numbers of
+    entries added, already in the cache, and in conflict.
+    """
+
+    source = open_cache(filename)
+    added, same, conflicts = 0, 0, 0
+    for chunk in _chunks(source.items(), MERGE_CHUNK_SIZE):
+        found = cache.get_many([key for key, value in chunk])
+        for key, value in chunk:
+            if key not in found:
+                cache.set(key, value)
+                added += 1
+            elif found[key] == value:
+                same += 1
+            else:
+                conflicts += 1
+                if conflict is not None:
+                    conflict(key, found[key], value)
+
+    if isinstance(source, rewritetex.SqliteCache):
+        for key, count in source.hits():
+            cache.add_hits(key, count)
+        source.save()
+
+    cache.flush()
+    return added, same, conflicts
+
+def rekey(cache, conflict=None):
+    """
+    Renormalizes the keys of the given SQLite cache with the current
+    normalize_tex(), merging entries that become equal as for merge().
+    Failures under changed keys are dropped, to be retried. Returns
+    the numbers of entries rekeyed and in conflict.
+
+    Keys are normalized tex documents, so this assumes that
+    normalize_tex() only ever becomes more aggressive.
+    """
+
+    normalize_tex = rewritetex.normalize_tex
+
+    cache.flush()
+    cursor = cache.db.cursor()
+    cursor.execute('SELECT tex, txt FROM tex2txt')
+    moved = [(key, normalize_tex(key), value) for key, value in cursor
+             if normalize_tex(key) != key]
+    cursor.execute('SELECT tex, hits FROM tex2txt_hits')
+    moved_hits = [(key, normalize_tex(key), count) for key, count in cursor
+                  if normalize_tex(key) != key]
+    cursor.execute('SELECT tex FROM tex2txt_failed')
+    moved_failed = [(key,) for key, in cursor if normalize_tex(key) != key]
+
+    cursor.executemany('DELETE FROM tex2txt WHERE tex = ?',
+                       [(key,) for key, new, value in moved])
+    cursor.executemany('DELETE FROM tex2txt_hits WHERE tex = ?',
+                       [(key,) for key, new, count in moved_hits])
+    cursor.executemany('DELETE FROM tex2txt_failed WHERE tex = ?',
+                       moved_failed)
+    cursor.close()
+
+    rekeyed, conflicts = 0, 0
+    for key, new, value in moved:
+        kept = cache.get(new)
+        if kept is None:
+            cache.set(new, value)
+            rekeyed += 1
+        elif kept != value:
+            conflicts += 1
+            if conflict is not None:
+                conflict(new, kept, value)
+    for key, new, count in moved_hits:
+        cache.add_hits(new, count)
+
+    cache.flush()
+    cache.db.commit()
+    return rekeyed, conflicts
+
+def compact(cache, filename):
+    """
+    Drops failures recorded with other than the current tex toolchain
+    or for transient reasons such as timeouts (which would be retried
+    anyway) and hit counts of entries not in the given SQLite cache,
+    and reclaims unused space in its file.
+    Returns the number of failures dropped and bytes reclaimed.
+    """
+
+    toolchain = rewritetex.tex_toolchain()
+    size = db_size(filename)
+
+    cache.flush()
+    cursor = cache.db.cursor()
+    dropped = 0
+    if 'unknown' not in toolchain:
+        cursor.execute('DELETE FROM tex2txt_failed WHERE toolchain != ?',
+                       (toolchain,))
+        dropped = cursor.rowcount
+    else:
+        print >> sys.stderr, 'texcache: tex toolchain not found, keeping failures'
+    transient = sorted(rewritetex.TRANSIENT_FAILURES)
+    cursor.execute('DELETE FROM tex2txt_failed WHERE reason IN (%s)' %
+                   ','.join('?' * len(transient)), transient)
+    dropped += cursor.rowcount
+    cursor.execute('DELETE FROM tex2txt_hits'
+                   '  WHERE tex NOT IN (SELECT tex FROM tex2txt)')
+    cache.db.commit()
+    cursor.execute('VACUUM')
+    # in WAL mode, the vacuumed database is written through the log
+    cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    cursor.close()
+
+    return dropped, size - db_size(filename)
+
+def print_stats(cache, filename, n):
+    """
+    Prints the size of the given SQLite cache, its failures by reason
+    and the distribution of hits over its entries, listing the n most
+    frequently used entries.
+    """
+
+    cursor = cache.db.cursor()
+    cursor.execute('SELECT COUNT(*), SUM(LENGTH(tex)), SUM(LENGTH(txt))'
+                   '  FROM tex2txt')
+    entries, key_chars, value_chars = cursor.fetchone()
+    print 'file\t%s\t%d bytes' % (filename, db_size(filename))
+    print 'entries\t%d\t%d tex chars\t%d text chars' % \
+        (entries, key_chars or 0, value_chars or 0)
+
+    cursor.execute('SELECT reason, COUNT(*), SUM(count) FROM tex2txt_failed'
+                   '  GROUP BY reason ORDER BY reason')
+    for reason, count, attempts in cursor.fetchall():
+        print 'failed\t%s\t%d\t%d attempts' % (reason, count, attempts)
+
+    cursor.execute('SELECT COUNT(*), SUM(hits) FROM tex2txt_hits'
+                   '  WHERE tex IN (SELECT tex FROM tex2txt)')
+    used, hits = cursor.fetchone()
+    print 'hits\t%d\t%d entries used\t%d never used' % \
+        (hits or 0, used, entries - used)
+    for threshold in (1, 10, 100, 1000):
+        cursor.execute('SELECT COUNT(*), SUM(hits) FROM tex2txt_hits'
+                       '  WHERE hits >= ?', (threshold,))
+        count, sum_ = cursor.fetchone()
+        if not count:
+            break
+        print 'hits>=%d\t%d entries\t%.1f%% of hits' % \
+            (threshold, count, 100.0*(sum_ or 0)/(hits or 1))
+
+    cursor.execute('SELECT tex, hits FROM tex2txt_hits'
+                   '  ORDER BY hits DESC LIMIT ?', (n,))
+    for key, count in cursor.fetchall():
+        print 'top\t%d\t%s' % (count, key.encode(rewritetex.OUTPUT_ENCODING))
+    cursor.close()
+
+def argparser():
+    import argparse
+    ap=argparse.ArgumentParser(description='Maintain the cache of tex document to text mappings.')
+    ap.add_argument('-D', '--db', default=rewritetex.SQLITE_CACHE_PATH, metavar='FILE', help='SQLite cache (default %s)' % os.path.normpath(rewritetex.SQLITE_CACHE_PATH))
+    ap.add_argument('-m', '--merge', '-i', '--import', default=[], nargs='+', metavar='FILE', help='merge the caches (SQLite, pickle or snapshot) in FILEs into the cache')
+    ap.add_argument('-r', '--rekey', default=False, action='store_true', help='renormalize keys after changes to normalize_tex()')
+    ap.add_argument('-c', '--compact', default=False, action='store_true', help='drop stale failures and vacuum the database')
+    ap.add_argument('-s', '--stats', default=False, action='store_true', help='print size and hit frequency statistics')
+    ap.add_argument('-n', '--top', default=10, type=int, metavar='N', help='number of most used entries in statistics (default 10)')
+    ap.add_argument('-e', '--export', default=None, metavar='FILE', help='write a read-only snapshot of the cache into FILE')
+    ap.add_argument('-v', '--verbose', default=False, action='store_true', help='report each conflicting entry')
+    return ap
+
+def main(argv):
+    ap = argparser()
+    options = ap.parse_args(argv[1:])
+    if not (options.merge or options.rekey or options.compact or
+            options.stats or options.export is not None):
+        ap.error('no action given')
+
+    conflict = report_conflict if options.verbose else None
+
+    # used directly rather than through get_cache(), so that
+    # maintenance lookups do not count as uses of the entries
+    cache = rewritetex.SqliteCache.load(options.db)
+
+    try:
+        for fn in options.merge:
+            added, same, conflicts = merge(cache, fn, conflict)
+            print >> sys.stderr, 'texcache: merged %s: %d added, %d already in cache, %d conflicts' % (fn, added, same, conflicts)
+
+        if options.rekey:
+            rekeyed, conflicts = rekey(cache, conflict)
+            print >> sys.stderr, 'texcache: rekeyed %d entries, %d conflicts' % (rekeyed, conflicts)
+
+        if options.compact:
+            dropped, reclaimed = compact(cache, options.db)
+            print >> sys.stderr, 'texcache: dropped %d stale failures, reclaimed %d bytes' % (dropped, reclaimed)
+
+        if options.stats:
+            print_stats(cache, options.db, options.top)
+
+        if options.export is not None:
+            count = export_snapshot(cache, options.export)
+            print >> sys.stderr, 'texcache: exported %d entries' % count
+    finally:
+        cache.save()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+# In-process conversion of simple tex math documents to text.
+
+# This module is not meant to be run directly; rewritetex uses it to
+# convert <tex-math> documents in a well-defined subset of tex without
+# invoking latex and catdvi, falling back to these for the rest. The
+# subset is that of documents with a preamble of standard declarations
+# (document class, standard math packages, lengths and page style) and
+# a body consisting of a single formula in $...$, $$...$$, \(...\) or
+# \[...\] built from
+#
+#    - letters, digits and common punctuation
+#    - sub- and superscripts and {} grouping
+#    - Greek letters (also from upgreek) and the common math symbols
+#      and operator names listed below
+#    - \frac, \sqrt, \mathbb and font and style switches
+#    - \left and \right delimiters and horizontal spacing
+#
+# The output follows that of catdvi in sequential mode: characters in
+# the order they appear in the DVI file, fraction numerators and
+# denominators separated by space, and whitespace normalized as in
+# rewritetex. As TeX puts a superscript above a subscript, both
+# scripts of a nucleus are output superscript first regardless of
+# the order in the source, inline after the nucleus, and limits above
+# and below an operator as the upper limit, the operator and the
+# lower limit.
+
+import re
+
+# packages that do not affect the subset
+SUPPORTED_PACKAGES = set(['amsbsy', 'amsfonts', 'amsmath', 'amssymb',
+                          'mathrsfs', 'upgreek', 'wasysym'])
+
+# Greek letters, also supported with the "up" prefix of upgreek
+GREEK = {
+    'alpha': u'\u03b1', 'beta': u'\u03b2', 'gamma': u'\u03b3',
+    'delta': u'\u03b4', 'epsilon': u'\u03f5', 'varepsilon': u'\u03b5',
+    'zeta': u'\u03b6', 'eta': u'\u03b7', 'theta': u'\u03b8',
+    'vartheta': u'\u03d1', 'iota': u'\u03b9', 'kappa': u'\u03ba',
+    'lambda': u'\u03bb', 'mu': u'\u03bc', 'nu': u'\u03bd', 'xi': u'\u03be',
+    'pi': u'\u03c0', 'varpi': u'\u03d6', 'rho': u'\u03c1',
+    'varrho': u'\u03f1', 'sigma': u'\u03c3', 'varsigma': u'\u03c2',
+    'tau': u'\u03c4', 'upsilon': u'\u03c5', 'phi': u'\u03d5',
+    'varphi': u'\u03c6', 'chi': u'\u03c7', 'psi': u'\u03c8',
+    'omega': u'\u03c9',
+    'Gamma': u'\u0393', 'Delta': u'\u0394', 'Theta': u'\u0398',
+    'Lambda': u'\u039b', 'Xi': u'\u039e', 'Pi': u'\u03a0',
+    'Sigma': u'\u03a3', 'Upsilon': u'\u03a5', 'Phi': u'\u03a6',
+    'Psi': u'\u03a8', 'Omega': u'\u03a9',
+}
+
+# symbol commands
+SYMBOLS = {
+    'pm': u'\u00b1', 'mp': u'\u2213', 'times': u'\u00d7', 'div': u'\u00f7',
+    'cdot': u'\u22c5', 'ast': u'\u2217', 'star': u'\u22c6',
+    'circ': u'\u2218', 'bullet': u'\u2219', 'oplus': u'\u2295',
+    'otimes': u'\u2297', 'cup': u'\u222a', 'cap': u'\u2229',
+    'wedge': u'\u2227', 'land': u'\u2227', 'vee': u'\u2228',
+    'lor': u'\u2228', 'setminus': u'\u2216', 'dagger': u'\u2020',
+    'leq': u'\u2264', 'le': u'\u2264', 'geq': u'\u2265', 'ge': u'\u2265',
+    'leqslant': u'\u2a7d', 'geqslant': u'\u2a7e', 'neq': u'\u2260',
+    'ne': u'\u2260', 'll': u'\u226a', 'gg': u'\u226b',
+    'approx': u'\u2248', 'sim': u'\u223c', 'simeq': u'\u2243',
+    'cong': u'\u2245', 'equiv': u'\u2261', 'propto': u'\u221d',
+    'lesssim': u'\u2272', 'gtrsim': u'\u2273', 'in': u'\u2208',
+    'notin': u'\u2209', 'ni': u'\u220b', 'subset': u'\u2282',
+    'supset': u'\u2283', 'subseteq': u'\u2286', 'supseteq': u'\u2287',
+    'perp': u'\u22a5', 'parallel': u'\u2225', 'mid': u'|',
+    'to': u'\u2192', 'rightarrow': u'\u2192', 'leftarrow': u'\u2190',
+    'gets': u'\u2190', 'leftrightarrow': u'\u2194',
+    'Rightarrow': u'\u21d2', 'Leftarrow': u'\u21d0',
+    'Leftrightarrow': u'\u21d4', 'uparrow': u'\u2191',
+    'downarrow': u'\u2193', 'mapsto': u'\u21a6',
+    'longrightarrow': u'\u27f6', 'infty': u'\u221e',
+    'partial': u'\u2202', 'nabla': u'\u2207', 'forall': u'\u2200',
+    'exists': u'\u2203', 'neg': u'\u00ac', 'lnot': u'\u00ac',
+    'emptyset': u'\u2205', 'ell': u'\u2113', 'hbar': u'\u210f',
+    'aleph': u'\u2135', 'Re': u'\u211c', 'Im': u'\u2111',
+    'angle': u'\u2220', 'triangle': u'\u25b3', 'prime': u'\u2032',
+    'surd': u'\u221a', 'top': u'\u22a4', 'bot': u'\u22a5',
+    'ldots': u'\u2026', 'dots': u'\u2026', 'cdots': u'\u22ef',
+    'sum': u'\u2211', 'prod': u'\u220f', 'int': u'\u222b',
+    'oint': u'\u222e', 'vert': u'|', '|': u'\u2016', 'Vert': u'\u2016',
+    'lbrace': u'{', 'rbrace': u'}', '{': u'{', '}': u'}',
+    'langle': u'\u27e8', 'rangle': u'\u27e9', 'lceil': u'\u2308',
+    'rceil': u'\u2309', 'lfloor': u'\u230a', 'rfloor': u'\u230b',
+    '%': u'%', '#': u'#', '&': u'&', '_': u'_', 'colon': u':',
+}
+
+# operator names, typeset upright and followed by space
+OPERATORS = set(['arccos', 'arcsin', 'arctan', 'arg', 'cos', 'cosh', 'cot',
+                 'coth', 'deg', 'det', 'dim', 'exp', 'gcd', 'inf', 'ker',
+                 'lg', 'lim', 'liminf', 'limsup', 'ln', 'log', 'max',
+                 'min', 'Pr', 'sec', 'sin', 'sinh', 'sup', 'tan', 'tanh'])
+
+# operators taking limits in display style unless followed by
+# \nolimits (other operators do only if followed by \limits)
+DISPLAY_LIMITS = set(['sum', 'prod', 'det', 'gcd', 'inf', 'lim', 'liminf',
+                      'limsup', 'max', 'min', 'Pr', 'sup'])
+
+# large operators among the symbol commands
+LARGE_OPERATORS = set(['sum', 'prod', 'int', 'oint'])
+
+# commands that only affect layout or style
+IGNORED = set(['big', 'Big',
+               'bigg', 'Bigg', 'bigl', 'bigr', 'Bigl', 'Bigr', 'biggl',
+               'biggr', 'Biggl', 'Biggr', ',', ';', ':', '!', '>',
+               'rm', 'it', 'bf', 'sf', 'tt', 'cal'])
+
+# commands setting the math style, mapped to whether it is display
+STYLES = {
+    'displaystyle': True, 'textstyle': False, 'scriptstyle': False,
+    'scriptscriptstyle': False,
+}
+
+# commands for horizontal space that catdvi outputs as space
+SPACES = set(['quad', 'qquad', ' ', 'enspace'])
+
+# commands taking one math argument that is typeset in another font
+MATH_FONTS = set(['mathrm', 'mathit', 'mathbf', 'mathsf', 'mathtt',
+                  'boldsymbol', 'bm', 'pmb', 'operatorname'])
+
+# commands taking one text argument
+TEXT_FONTS = set(['text', 'textrm', 'textit', 'textbf', 'textsf',
+                  'texttt', 'mbox', 'textnormal'])
+
+# double-struck letters in the Basic Multilingual Plane
+DOUBLE_STRUCK = {
+    'C': u'\u2102', 'H': u'\u210d', 'N': u'\u2115', 'P': u'\u2119',
+    'Q': u'\u211a', 'R': u'\u211d', 'Z': u'\u2124',
+}
+
+# characters that typeset differently in math mode
+MATH_CHARS = {
+    '-': u'\u2212', '*': u'\u2217', "'": u'\u2032',
+}
+
+# other characters allowed as such in math mode
+PLAIN_CHARS = set('abcdefghijklmnopqrstuvwxyz'
+                  'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                  '0123456789+=<>()[]/|,.;:!?@')
+
+# characters allowed in text arguments
+TEXT_CHARS = set('abcdefghijklmnopqrstuvwxyz'
+                 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                 '0123456789+=()[]/,.;:!?- ')
+
+# pre-compiled regular expressions
+
+# document with a preamble of standard declarations
+document_re = re.compile(r'^\s*((?:\\(?:documentclass|usepackage|setlength|pagestyle)(?:\[[^\[\]]*\])?(?:\{[^\{\}]*\})*\s*)*)\\begin\{document\}(.*)\\end\{document\}\s*$', re.S)
+# package includes
+package_re = re.compile(r'\\usepackage(?:\[[^\[\]]*\])?\{([^\{\}]*)\}')
+# math in the supported delimiters, with whether they start display
+# math
+math_res = [(re.compile(r'^\$\$([^$]*)\$\$$'), True),
+            (re.compile(r'^\$([^$]*)\$$'), False),
+            (re.compile(r'^\\\[(.*)\\\]$', re.S), True),
+            (re.compile(r'^\\\((.*)\\\)$', re.S), False)]
+# tex tokens: control words and symbols, space and characters
+token_re = re.compile(r'\\[a-zA-Z]+|\\.|\s+|.', re.S)
+# consequtive space
+space_re = re.compile(r'\s+')
+
+class Unsupported(Exception):
+    """
+    Raised for tex outside of the supported subset.
+    """
+    pass
+
+class _Parser(object):
+    def __init__(self, tex, display=False):
+        self.tokens = token_re.findall(tex)
+        self.i = 0
+        # whether the current style is display style
+        self.display = display
+
+    def next(self, space=False):
+        # space is ignored in math mode
+        while not space and self.i < len(self.tokens) and \
+                self.tokens[self.i].isspace():
+            self.i += 1
+        if self.i >= len(self.tokens):
+            raise Unsupported('unexpected end of formula')
+        token = self.tokens[self.i]
+        self.i += 1
+        return token
+
+    def peek(self):
+        while self.i < len(self.tokens) and self.tokens[self.i].isspace():
+            self.i += 1
+        if self.i >= len(self.tokens):
+            return None
+        return self.tokens[self.i]
+
+    def parse(self):
+        """
+        Returns the text of the whole formula.
+        """
+
+        text = self.group(None)
+        if self.peek() is not None:
+            raise Unsupported('unbalanced braces')
+        return text
+
+    def group(self, end='}'):
+        # style changes are local to the group
+        display = self.display
+        parts = []
+        while True:
+            if self.peek() is None and end is None:
+                break
+            token = self.next()
+            if token == end:
+                break
+            parts.append(self.atom(token))
+        self.display = display
+        return u''.join(parts)
+
+    def argument(self, display=None):
+        """
+        Returns the text of an argument, set in display style if
+        display is True, in a smaller style if False and in the
+        current style if None.
+        """
+
+        current = self.display
+        if display is not None:
+            self.display = display
+        token = self.next()
+        if token == '{':
+            text = self.group()
+        else:
+            text = self.item(token)
+        self.display = current
+        return text
+
+    def raw_argument(self):
+        """
+        Returns the tokens of a braced argument, including space,
+        without interpreting them.
+        """
+
+        if self.next() != '{':
+            raise Unsupported('expected {')
+        tokens = []
+        while True:
+            token = self.next(space=True)
+            if token == '}':
+                return tokens
+            tokens.append(token)
+
+    def atom(self, token):
+        """
+        Returns the text of the nucleus starting with the given token
+        together with its sub- and superscripts or limits.
+        """
+
+        if token in ('^', '_', "'"):
+            # scripts without a nucleus
+            self.i -= 1
+            nucleus = u''
+        else:
+            nucleus = self.item(token)
+
+        name = token[1:] if token.startswith('\\') else None
+        operator = name in OPERATORS or name in LARGE_OPERATORS
+        limits = self.display and name in DISPLAY_LIMITS
+
+        superscript, subscript = None, None
+        while True:
+            token = self.peek()
+            if token in ('\\limits', '\\nolimits'):
+                if not operator:
+                    raise Unsupported(token + ' without operator')
+                self.next()
+                limits = token == '\\limits'
+            elif token in ('^', "'"):
+                if superscript is not None:
+                    raise Unsupported('double superscript')
+                # primes start a superscript that a following ^ adds to
+                superscript = u''
+                while self.peek() == "'":
+                    self.next()
+                    superscript += MATH_CHARS["'"]
+                if self.peek() == '^':
+                    self.next()
+                    superscript += self.argument(False)
+            elif token == '_':
+                if subscript is not None:
+                    raise Unsupported('double subscript')
+                self.next()
+                subscript = self.argument(False)
+            else:
+                break
+
+        # TeX sets the superscript or upper limit above the subscript
+        # or lower limit, and so outputs it first
+        superscript, subscript = superscript or u'', subscript or u''
+        if limits:
+            text = superscript + nucleus + subscript
+        else:
+            text = nucleus + superscript + subscript
+        if name in OPERATORS:
+            text += u' '
+        return text
+
+    def item(self, token):
+        if token == '{':
+            return self.group()
+        elif token == '~':
+            return u' '
+        elif token.startswith('\\'):
+            return self.command(token[1:])
+        elif token in MATH_CHARS:
+            return MATH_CHARS[token]
+        elif token in PLAIN_CHARS:
+            return unicode(token)
+        else:
+            raise Unsupported(token)
+
+    def command(self, name):
+        if name in GREEK:
+            return GREEK[name]
+        elif name.startswith('up') and name[2:] in GREEK:
+            return GREEK[name[2:]]
+        elif name in SYMBOLS:
+            return SYMBOLS[name]
+        elif name in OPERATORS:
+            return unicode(name)
+        elif name in STYLES:
+            self.display = STYLES[name]
+            return u''
+        elif name in IGNORED:
+            return u''
+        elif name in SPACES:
+            return u' '
+        elif name == 'hspace':
+            self.raw_argument()
+            return u' '
+        elif name in ('left', 'right'):
+            delimiter = self.next()
+            return u'' if delimiter == '.' else self.item(delimiter)
+        elif name in MATH_FONTS:
+            return self.argument()
+        elif name in TEXT_FONTS:
+            return self.text(self.raw_argument())
+        elif name in ('frac', 'dfrac', 'tfrac'):
+            # the parts are in display style only in \dfrac
+            numerator = self.argument(name == 'dfrac')
+            denominator = self.argument(name == 'dfrac')
+            return numerator + u' ' + denominator + u' '
+        elif name == 'sqrt':
+            if self.peek() == '[':
+                raise Unsupported('\\sqrt with index')
+            return SYMBOLS['surd'] + self.argument()
+        elif name == 'mathbb':
+            return u''.join(self.double_struck(t) for t in self.raw_argument()
+                            if not t.isspace())
+        else:
+            raise Unsupported('\\' + name)
+
+    def text(self, tokens):
+        # only plain text without commands is supported
+        for token in tokens:
+            if not token.isspace() and token not in TEXT_CHARS:
+                raise Unsupported('text ' + token)
+        return u''.join(tokens)
+
+    def double_struck(self, token):
+        if token not in DOUBLE_STRUCK:
+            raise Unsupported('\\mathbb{%s}' % token)
+        return DOUBLE_STRUCK[token]
+
+def supported_preamble(preamble):
+    for m in package_re.finditer(preamble):
+        for package in m.group(1).split(','):
+            if package.strip() not in SUPPORTED_PACKAGES:
+                return False
+    return True
+
+def math_content(body):
+    """
+    Returns a (math, display) pair for the formula making up the given
+    document body, or None if there is no such formula.
+    """
+
+    body = body.strip()
+    for math_re, display in math_res:
+        m = math_re.match(body)
+        if m:
+            return m.group(1), display
+    return None
+
+def tex2str(tex):
+    """
+    Given a tex document prepared with rewritetex.prepare_tex(),
+    returns a text string approximating the tex content as catdvi
+    would, or None if the document is outside of the supported subset.
+    """
+
+    m = document_re.match(tex)
+    if m is None or not supported_preamble(m.group(1)):
+        return None
+
+    content = math_content(m.group(2))
+    if content is None:
+        return None
+
+    try:
+        text = _Parser(*content).parse()
+    except Unsupported:
+        return None
+
+    text = space_re.sub(u' ', text).strip()
+    if text == u'':
+        return None
+    return text
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Per-stage timing and profiling of the nxml2txt pipeline.
+
+# This module is not meant to be run directly; the nxml2txt driver
+# records wall time, CPU time and growth of resident memory for each
+# stage of each document when given the -T option, and writes cProfile
+# output for each stage when given --profile, e.g.
+#
+#    ./nxml2txt -T timing.tsv --profile PROFDIR -d OUTDIR CORPUSDIR
+#    python -m pstats PROFDIR/respace.prof
+
+from __future__ import with_statement
+
+import os
+import time
+import glob
+import resource
+
+# suffix of cProfile output files
+PROFILE_SUFFIX = '.prof'
+
+# source of the current resident set size (in pages, the second field)
+STATM_PATH = '/proc/self/statm'
+
+PAGE_KB = resource.getpagesize() // 1024
+
+def _cpu():
+    """
+    Returns the CPU seconds used by the current process.
+    """
+
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+def _rss():
+    """
+    Returns the resident set size of the current process in kilobytes.
+    Where it is not available, returns the peak resident set size,
+    which only grows when a stage exceeds the previous peak.
+    """
+
+    try:
+        with open(STATM_PATH) as f:
+            return int(f.read().split()[1]) * PAGE_KB
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+class NullTimer(object):
+    """
+    Timer that records nothing, used when instrumentation is off.
+    """
+
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.profile = self.timer.profiler(self.name)
+        self.cpu = _cpu()
+        self.rss = _rss()
+        self.wall = time.time()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+        wall = time.time() - self.wall
+        cpu, rss = _cpu(), _rss()
+        self.timer.document.append((self.name, wall, cpu - self.cpu,
+                                    rss - self.rss))
+        return False
+
+class StageTimer(object):
+    """
+    Records (stage, wall seconds, CPU seconds, growth of resident
+    memory in KB) for the stages of the current document, optionally
+    profiling each stage with cProfile.
+    """
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.profiles = {}
+        self.document = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def profiler(self, name):
+        if not self.profile:
+            return None
+        if name not in self.profiles:
+            import cProfile
+            self.profiles[name] = cProfile.Profile()
+        return self.profiles[name]
+
+    def pop_document(self):
+        """
+        Returns the timings recorded since the last call and starts
+        recording a new document.
+        """
+
+        document, self.document = self.document, []
+        return document
+
+    def dump_profiles(self, directory):
+        """
+        Writes the accumulated profile of each stage into the given
+        directory, one file per stage and process.
+        """
+
+        for name, profile in self.profiles.items():
+            fn = '%s.%d%s' % (name, os.getpid(), PROFILE_SUFFIX)
+            profile.dump_stats(os.path.join(directory, fn))
+        self.profiles = {}
+
+def merge_profiles(directory):
+    """
+    Merges the per-process profiles written by dump_profiles() into
+    a single pstats file per stage.
+    """
+
+    import pstats
+
+    by_stage = {}
+    for fn in glob.glob(os.path.join(directory, '*.*' + PROFILE_SUFFIX)):
+        name = os.path.basename(fn).split('.')[0]
+        by_stage.setdefault(name, []).append(fn)
+
+    for name, fns in by_stage.items():
+        stats = pstats.Stats(*fns)
+        stats.dump_stats(os.path.join(directory, name + PROFILE_SUFFIX))
+        for fn in fns:
+            os.remove(fn)
+
+def format_timings(name, timings):
+    """
+    Returns the timings of a document as tab-separated lines of
+    document name, stage, wall seconds, CPU seconds and growth of
+    resident memory in KB.
+    """
+
+    return ''.join('%s\t%s\t%.6f\t%.6f\t%d\n' % ((name,) + t)
+                   for t in timings)
+
+class Summary(object):
+    """
+    Per-stage totals over a batch of documents, and the largest growth
+    of resident memory in a stage for a single document.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.totals = {}
+        self.documents = 0
+
+    def add(self, timings):
+        self.documents += 1
+        for name, wall, cpu, rss in timings:
+            if name not in self.totals:
+                self.stages.append(name)
+                self.totals[name] = [0.0, 0.0, 0]
+            t = self.totals[name]
+            t[0] += wall
+            t[1] += cpu
+            t[2] = max(t[2], rss)
+
+    def __str__(self):
+        total_wall = sum(t[0] for t in self.totals.values()) or 1.0
+        n = max(self.documents, 1)
+        lines = ['%-12s %10s %10s %6s %10s %10s' %
+                 ('stage', 'wall (s)', 'cpu (s)', 'wall%', 'ms/doc', 'max +KB')]
+        for name in self.stages:
+            wall, cpu, rss = self.totals[name]
+            lines.append('%-12s %10.3f %10.3f %5.1f%% %10.2f %10d' %
+                         (name, wall, cpu, 100.0*wall/total_wall,
+                          1000.0*wall/n, rss))
+        lines.append('%d documents' % self.documents)
+        return '\n'.join(lines)
@@ -0,0 +1,55 @@
+#!/bin/bash
+
+# Compare the output of the nxml2txt driver, which runs the pipeline
+# stages with fused traversals of the tree, to that of running the
+# stages one after another as in nxml2txt.sh for the given NXML files,
+# or the test documents if none are given.
+
+set -u
+
+# http://stackoverflow.com/a/246128
+DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
+ROOT=$( cd "$DIR/.." && pwd )
+SRC=$ROOT/src
+
+if [ $# -gt 0 ]; then
+    files=("$@")
+else
+    files=("$DIR"/*.nxml)
+fi
+
+tmpdir=$(mktemp -d)
+trap 'rm -rf "$tmpdir"' EXIT
+
+# as nxml2txt.sh, but keeping characters missing from the Unicode
+# mapping as the driver does (missing-mappings.txt goes into tmpdir)
+staged() {
+    ( cd "$tmpdir" &&
+        cat "$1" |
+        python $SRC/rewritetex.py - -s |
+        python $SRC/rewritemmla.py - -s |
+        python $SRC/respace.py - -s |
+        python $SRC/rewriteu2a.py - -s -k |
+        python $SRC/standoff.py - "$2" "$3" )
+}
+
+failed=0
+for nxmlfn in "${files[@]}"; do
+    nxmlfn=$( cd "$( dirname "$nxmlfn" )" && pwd )/$( basename "$nxmlfn" )
+    base=$tmpdir/$(basename "$nxmlfn" .nxml)
+    if ! staged "$nxmlfn" $base.staged.txt $base.staged.so 2>$base.staged.log ||
+        ! python "$ROOT"/nxml2txt "$nxmlfn" $base.txt $base.so 2>$base.log; then
+        echo "$nxmlfn: conversion failed"
+        failed=1
+    elif ! cmp -s $base.staged.txt $base.txt || ! cmp -s $base.staged.so $base.so; then
+        echo "$nxmlfn: output differs"
+        diff $base.staged.txt $base.txt | head -n 10
+        diff $base.staged.so $base.so | head -n 10
+        failed=1
+    fi
+done
+
+if [ $failed -eq 0 ]; then
+    echo "${#files[@]} files, output identical"
+fi
+exit $failed
@@ -0,0 +1,21 @@
+#!/bin/bash
+
+# Compare the in-process conversions of simple TeX formulas (texmath)
+# to the catdvi conversions of the same formulas in the TeX cache
+# (data/tex2txt.db) for the given NXML files, or the test documents
+# if none are given. Formulas missing from the cache can be added by
+# converting them with tex and catdvi: src/rewritetex.py -x -s FILE
+
+set -u
+
+# http://stackoverflow.com/a/246128
+DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
+SRC=$( cd "$DIR/.." && pwd )/src
+
+if [ $# -gt 0 ]; then
+    files=("$@")
+else
+    files=("$DIR"/*.nxml)
+fi
+
+python "$SRC"/extracttex.py -c "${files[@]}"